@@ -0,0 +1,405 @@
+"""
+Light stand-ins for Discord, Prisma and Redis, which count the calls made to them.
+
+They only implement what the voice state pipeline touches, so the benchmarks can run
+without a bot token, database or Redis server.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import itertools
+import time
+from collections import Counter
+from types import SimpleNamespace
+from typing import Any, Callable, Optional
+
+from prisma.models import Link
+
+from utils.client import VCRolesClient
+from utils.database import DatabaseUtils
+from utils.warm_up import CacheWarmUp
+
+
+class FakeRole:
+    __slots__ = ("id", "guild", "assignable")
+
+    def __init__(self, role_id: int, guild: FakeGuild, assignable: bool = True):
+        self.id = role_id
+        self.guild = guild
+        self.assignable = assignable
+
+    def is_assignable(self) -> bool:
+        return self.assignable
+
+    @property
+    def mention(self) -> str:
+        return f"<@&{self.id}>"
+
+
+class FakeCategory:
+    __slots__ = ("id",)
+
+    def __init__(self, category_id: int):
+        self.id = category_id
+
+
+class FakeChannel:
+    __slots__ = ("id", "guild", "category", "voice_states")
+
+    def __init__(
+        self, channel_id: int, guild: FakeGuild, category: Optional[FakeCategory]
+    ):
+        self.id = channel_id
+        self.guild = guild
+        self.category = category
+        self.voice_states: dict[int, FakeVoiceState] = {}
+
+    @property
+    def mention(self) -> str:
+        return f"<#{self.id}>"
+
+    @property
+    def members(self) -> list[FakeMember]:
+        return [m for m in map(self.guild.get_member, self.voice_states) if m]
+
+
+class FakeVoiceState:
+    __slots__ = ("channel", "suppress")
+
+    def __init__(self, channel: Optional[FakeChannel]):
+        self.channel = channel
+        self.suppress = False
+
+
+class FakeMember:
+    __slots__ = ("id", "guild", "bot", "name", "nick", "roles", "voice", "avatar")
+
+    def __init__(self, member_id: int, guild: FakeGuild):
+        self.id = member_id
+        self.guild = guild
+        self.bot = False
+        self.name = f"member{member_id}"
+        self.nick: Optional[str] = None
+        self.roles: list[FakeRole] = [guild.default_role]
+        self.voice: Optional[FakeVoiceState] = None
+        self.avatar = None
+
+    def __str__(self) -> str:
+        return self.name
+
+    @property
+    def display_name(self) -> str:
+        return self.nick or self.name
+
+    @property
+    def mention(self) -> str:
+        return f"<@{self.id}>"
+
+    def get_role(self, role_id: int) -> Optional[FakeRole]:
+        return next((r for r in self.roles if r.id == role_id), None)
+
+    @property
+    def _roles(self) -> list[int]:
+        return [r.id for r in self.roles[1:]]
+
+    async def move_to(self, channel: Any, **kwargs: Any) -> None:
+        self.guild.rest.record("member.move_to")
+
+
+class RestCounter:
+    """Counts the REST calls made, with an optional simulated latency"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter[str] = Counter()
+
+    def record(self, route: str) -> None:
+        self.calls[route] += 1
+
+    @property
+    def total(self) -> int:
+        return sum(self.calls.values())
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, rest: RestCounter, shard_id: int = 0):
+        self.id = guild_id
+        self.rest = rest
+        self.shard_id = shard_id
+        self.owner_id = 0
+        self.default_role = FakeRole(guild_id, self)
+        self.roles: dict[int, FakeRole] = {guild_id: self.default_role}
+        self.channels: dict[int, FakeChannel] = {}
+        self._members: dict[int, FakeMember] = {}
+
+    @property
+    def voice_channels(self) -> list[FakeChannel]:
+        return list(self.channels.values())
+
+    @property
+    def stage_channels(self) -> list[FakeChannel]:
+        return []
+
+    @property
+    def members(self) -> list[FakeMember]:
+        return list(self._members.values())
+
+    def get_role(self, role_id: int) -> Optional[FakeRole]:
+        return self.roles.get(role_id)
+
+    def get_channel(self, channel_id: int) -> Optional[FakeChannel]:
+        return self.channels.get(channel_id)
+
+    def get_member(self, member_id: int) -> Optional[FakeMember]:
+        return self._members.get(member_id)
+
+    def _voice_state_for(self, member_id: int) -> Optional[FakeVoiceState]:
+        member = self._members.get(member_id)
+        return member.voice if member else None
+
+    async def fetch_member(self, member_id: int) -> FakeMember:
+        self.rest.record("guild.fetch_member")
+        if self.rest.latency:
+            await asyncio.sleep(self.rest.latency)
+        return self._members[member_id]
+
+
+class FakeModel:
+    """A Prisma model client which counts its queries"""
+
+    def __init__(self, name: str, prisma: FakePrisma):
+        self.name = name
+        self.prisma = prisma
+
+    def __getattr__(self, action: str) -> Callable[..., Any]:
+        async def query(*args: Any, **kwargs: Any) -> Any:
+            self.prisma.queries[f"{self.name}.{action}"] += 1
+            if self.prisma.latency:
+                await asyncio.sleep(self.prisma.latency)
+            return self.prisma.handle(self.name, action, args, kwargs)
+
+        return query
+
+
+class FakePrisma:
+    """An in-memory stand-in for the Prisma client, holding only links"""
+
+    def __init__(self, links: dict[str, list[Link]], latency: float = 0.0):
+        self.links = links
+        self.latency = latency
+        self.queries: Counter[str] = Counter()
+
+    def __getattr__(self, name: str) -> FakeModel:
+        return FakeModel(name, self)
+
+    @property
+    def total(self) -> int:
+        return sum(self.queries.values())
+
+    async def query_raw(self, query: str, *args: Any, model: Any = None) -> Any:
+        self.queries["query_raw"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        links = self.links.get(args[0], [])
+        if len(args) > 1:
+            links = [link for link in links if link.id in args[1]]
+        return links
+
+    def guild_record(self, guild_id: str) -> SimpleNamespace:
+        return SimpleNamespace(
+            id=guild_id,
+            links=self.links.get(guild_id, []),
+            logging=None,
+            ttsEnabled=False,
+            ttsRole=None,
+            ttsLeave=True,
+            botMasterRoles=[],
+            analytics=False,
+            premium=False,
+        )
+
+    def handle(
+        self, model: str, action: str, args: tuple[Any, ...], kwargs: dict[str, Any]
+    ) -> Any:
+        if model == "guild" and action in ("find_unique", "create"):
+            where = kwargs.get("where") or (args[0] if args else {})
+            return self.guild_record(where["id"])
+        if model == "guild" and action == "find_many":
+            return [self.guild_record(i) for i in kwargs["where"]["id"]["in"]]
+        if action in ("count", "delete_many"):
+            return 0
+        if action == "find_many":
+            return []
+        return None
+
+
+class FakePipeline:
+    def __init__(self, redis: FakeRedis):
+        self.redis = redis
+        self.commands: list[tuple[str, tuple[Any, ...], dict[str, Any]]] = []
+
+    async def __aenter__(self) -> FakePipeline:
+        return self
+
+    async def __aexit__(self, *exc: Any) -> None:
+        self.commands.clear()
+
+    def __getattr__(self, name: str) -> Callable[..., FakePipeline]:
+        def command(*args: Any, **kwargs: Any) -> FakePipeline:
+            self.commands.append((name, args, kwargs))
+            return self
+
+        return command
+
+    async def execute(self) -> list[Any]:
+        self.redis.round_trips += 1
+        results = []
+        for name, args, kwargs in self.commands:
+            self.redis.commands[name] += 1
+            results.append(self.redis.run(name, args, kwargs))
+        self.commands.clear()
+        return results
+
+
+class FakeRedis:
+    """An in-memory stand-in for redis.asyncio, implementing the commands the bot uses"""
+
+    def __init__(self) -> None:
+        self.commands: Counter[str] = Counter()
+        self.round_trips = 0
+        self.streams: dict[str, dict[str, dict[str, Any]]] = {}
+        self.sets: dict[str, set[str]] = {}
+        self.hashes: dict[str, dict[str, Any]] = {}
+        self.seq = itertools.count()
+
+    def __getattr__(self, name: str) -> Callable[..., Any]:
+        async def command(*args: Any, **kwargs: Any) -> Any:
+            self.round_trips += 1
+            self.commands[name] += 1
+            return self.run(name, args, kwargs)
+
+        return command
+
+    def pipeline(self, transaction: bool = True) -> FakePipeline:
+        return FakePipeline(self)
+
+    def run(self, name: str, args: tuple[Any, ...], kwargs: dict[str, Any]) -> Any:
+        if name == "xadd":
+            entry_id = f"{int(time.time() * 1000)}-{next(self.seq)}"
+            self.streams.setdefault(args[0], {})[entry_id] = args[1]
+            return entry_id
+        if name == "xdel":
+            stream = self.streams.get(args[0], {})
+            return sum(stream.pop(i, None) is not None for i in args[1:])
+        if name == "xrange":
+            return []
+        if name == "sadd":
+            self.sets.setdefault(args[0], set()).update(map(str, args[1:]))
+            return len(args) - 1
+        if name == "srem":
+            self.sets.get(args[0], set()).difference_update(map(str, args[1:]))
+            return len(args) - 1
+        if name == "smembers":
+            return set(self.sets.get(args[0], set()))
+        if name == "hincrby":
+            h = self.hashes.setdefault(args[0], {})
+            h[args[1]] = int(h.get(args[1], 0)) + int(args[2])
+            return h[args[1]]
+        if name in ("hget", "get"):
+            return None
+        return None
+
+    @property
+    def stream_length(self) -> int:
+        return sum(len(s) for s in self.streams.values())
+
+
+class FakeHTTP:
+    """The REST routes used by the VoiceState cog"""
+
+    def __init__(self, client: FakeClient):
+        self.client = client
+
+    async def edit_member(
+        self, guild_id: int, user_id: int, *, reason: Any = None, **fields: Any
+    ) -> dict[str, Any]:
+        guild = self.client._guilds[guild_id]
+        guild.rest.record("http.edit_member")
+        if guild.rest.latency:
+            await asyncio.sleep(guild.rest.latency)
+
+        member = guild._members[user_id]
+        if "nick" in fields:
+            member.nick = fields["nick"]
+        if "roles" in fields:
+            member.roles = [guild.default_role] + [
+                r for r in map(guild.get_role, fields["roles"]) if r
+            ]
+        return {
+            "user": {"id": str(member.id), "username": member.name},
+            "nick": member.nick,
+            "roles": [str(r) for r in member._roles],
+        }
+
+
+class FakeClient:
+    """The parts of VCRolesClient used by the VoiceState cog"""
+
+    incr_counter = VCRolesClient.incr_counter
+    incr_role_counter = VCRolesClient.incr_role_counter
+    flush_counters = VCRolesClient.flush_counters
+
+    def __init__(
+        self,
+        db: DatabaseUtils,
+        ar: FakeRedis,
+        guilds: list[FakeGuild],
+        rest: RestCounter,
+    ):
+        self.db = db
+        self.ar = ar
+        self.rest = rest
+        self.loop = asyncio.get_running_loop()
+        self.guilds = guilds
+        self._guilds = {g.id: g for g in guilds}
+        self.shards = {0: None}
+        self.http = FakeHTTP(self)
+        self.counter_deltas: dict[str, int] = {}
+        self.warm_up = CacheWarmUp(self)  # type: ignore
+        self.logs: Counter[str] = Counter()
+
+    def log(self, level: Any, message: str) -> None:
+        self.logs[str(level)] += 1
+
+    def get_guild(self, guild_id: int) -> Optional[FakeGuild]:
+        return self._guilds.get(guild_id)
+
+    def get_channel(self, channel_id: int) -> Any:
+        return None
+
+    async def fetch_channel(self, channel_id: int) -> Any:
+        self.rest.record("client.fetch_channel")
+        if self.rest.latency:
+            await asyncio.sleep(self.rest.latency)
+        for guild in self.guilds:
+            channel = guild.get_channel(channel_id)
+            if channel:
+                return channel
+        return None
+
+    async def wait_until_ready(self) -> None:
+        return None
+
+    def get_cog(self, name: str) -> Any:
+        return None
+
+
+def fake_database(prisma: FakePrisma) -> DatabaseUtils:
+    """A DatabaseUtils with its Prisma client replaced and its caches emptied"""
+    db = DatabaseUtils()
+    db.db = prisma  # type: ignore
+    for value in vars(DatabaseUtils).values():
+        if hasattr(value, "clear") and hasattr(value, "maxsize"):
+            value.clear()
+    return db
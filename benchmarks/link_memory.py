@@ -0,0 +1,130 @@
+"""
+Measures the memory used per cached link, as Prisma models and as compiled link indexes.
+
+Links are generated with the mix of types, roles, suffixes and excluded channels seen
+in production, spread across guilds, and the memory allocated while building each
+representation is measured with tracemalloc.
+
+    python -m benchmarks.link_memory --links 100000
+    python -m benchmarks.link_memory --links 100000 --json
+"""
+
+from __future__ import annotations
+
+import argparse
+import gc
+import itertools
+import json
+import random
+import tracemalloc
+from typing import Any, Callable
+
+from prisma.enums import LinkType
+from prisma.models import Link
+
+from utils.link_index import GuildLinkIndex
+
+
+def generate(
+    rng: random.Random, links: int, per_guild: int
+) -> dict[str, list[dict[str, Any]]]:
+    """Link rows as the database returns them, by guild ID"""
+    ids = itertools.count(10**17 + rng.randrange(10**17))
+    guilds: dict[str, list[dict[str, Any]]] = {}
+    while sum(map(len, guilds.values())) < links:
+        guild_id = str(next(ids))
+        roles = [str(next(ids)) for _ in range(30)]
+        rows = guilds[guild_id] = []
+        for _ in range(max(1, int(rng.expovariate(1 / per_guild)))):
+            link_type = rng.choices(
+                [LinkType.REGULAR, LinkType.CATEGORY, LinkType.PERMANENT, LinkType.ALL],
+                [70, 15, 10, 5],
+            )[0]
+            rows.append(
+                {
+                    "dbId": f"cl{rng.getrandbits(100):x}"[:25],
+                    "id": guild_id if link_type == LinkType.ALL else str(next(ids)),
+                    "type": link_type,
+                    "guildId": guild_id,
+                    "linkedRoles": rng.sample(roles, rng.randint(1, 3)),
+                    "reverseLinkedRoles": (
+                        rng.sample(roles, 1) if rng.random() < 0.2 else []
+                    ),
+                    "suffix": "[VC]" if rng.random() < 0.3 else None,
+                    "speakerRoles": [],
+                    "excludeChannels": (
+                        [str(next(ids)) for _ in range(rng.randint(1, 3))]
+                        if link_type == LinkType.ALL
+                        else []
+                    ),
+                }
+            )
+    return guilds
+
+
+def measure(build: Callable[[], Any]) -> tuple[Any, int]:
+    """Build something, returning it with the bytes it allocated and kept"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    value = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return value, after - before
+
+
+def run(args: argparse.Namespace) -> dict[str, Any]:
+    rng = random.Random(args.seed)
+    rows = generate(rng, args.links, args.per_guild)
+    count = sum(map(len, rows.values()))
+
+    models, model_bytes = measure(
+        lambda: {g: [Link(**r) for r in links] for g, links in rows.items()}
+    )
+    # Built from the models, as on a cache miss, but only the indexes are measured
+    indexes, index_bytes = measure(
+        lambda: {g: GuildLinkIndex(g, links) for g, links in models.items()}
+    )
+
+    return {
+        "guilds": len(rows),
+        "links": count,
+        "prisma_bytes": model_bytes,
+        "index_bytes": index_bytes,
+        "prisma_bytes_per_link": model_bytes / count,
+        "index_bytes_per_link": index_bytes / count,
+        "reduction": 1 - index_bytes / max(model_bytes, 1),
+    }
+
+
+def report(results: dict[str, Any]) -> None:
+    print(f"{results['links']:,} links across {results['guilds']:,} guilds")
+    print(
+        f"  Prisma models        {results['prisma_bytes'] / 2**20:8.1f} MiB"
+        f"  {results['prisma_bytes_per_link']:6.0f} B/link"
+    )
+    print(
+        f"  link indexes         {results['index_bytes'] / 2**20:8.1f} MiB"
+        f"  {results['index_bytes_per_link']:6.0f} B/link"
+    )
+    print(f"  reduction            {results['reduction']:.0%}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--links", type=int, default=100_000)
+    parser.add_argument("--per-guild", type=float, default=8, help="mean links")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Compares loading links through Prisma's nested include with the raw SQL fast path.
+
+Runs against the database in DATABASE_URL, using guilds which already have links, and
+reports the latency of each query and the CPU time this process spends per call.
+Prisma's query engine runs in its own process, so its CPU time isn't included.
+
+    python -m benchmarks.link_query --guilds 200 --iterations 2000
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Any, Awaitable, Callable
+
+from utils.database import DatabaseUtils
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def measure(
+    iterations: int, query: Callable[[int], Awaitable[Any]]
+) -> dict[str, float]:
+    latencies: list[float] = []
+    cpu = time.process_time()
+    for i in range(iterations):
+        t = time.perf_counter()
+        await query(i)
+        latencies.append(time.perf_counter() - t)
+    cpu = time.process_time() - cpu
+
+    return {
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": sum(latencies) * 1000 / max(iterations, 1),
+        "cpu_us_per_call": cpu * 1e6 / max(iterations, 1),
+    }
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    db = DatabaseUtils()
+    await db.connect()
+    try:
+        rows = await db.db.query_raw(
+            'SELECT "guildId", array_agg("id") AS ids FROM "Link"'
+            ' GROUP BY "guildId" ORDER BY random() LIMIT $1',
+            args.guilds,
+        )
+        if not rows:
+            raise SystemExit("There are no links in the database")
+
+        rng = random.Random(args.seed)
+        picks = [rng.choice(rows) for _ in range(args.iterations)]
+        channels = [(int(r["guildId"]), int(rng.choice(r["ids"]))) for r in picks]
+
+        async def index(i: int) -> Any:
+            return await db.load_links(channels[i][0])
+
+        async def channel(i: int) -> Any:
+            guild_id, channel_id = channels[i]
+            return await db.get_all_linked_channel(guild_id, channel_id)
+
+        # Both paths must return the same links
+        for i in range(min(args.iterations, 50)):
+            db.raw_link_queries = False
+            expected = sorted(link.dbId for link in await channel(i))
+            db.raw_link_queries = True
+            assert sorted(link.dbId for link in await channel(i)) == expected
+
+        results: dict[str, Any] = {"guilds": len(rows), "iterations": args.iterations}
+        for raw in (False, True):
+            db.raw_link_queries = raw
+            # Warm up the connection pool and prepared statements
+            await measure(min(args.iterations, 100), index)
+            path = "raw" if raw else "prisma"
+            results[f"{path}_guild_links"] = await measure(args.iterations, index)
+            results[f"{path}_channel_links"] = await measure(args.iterations, channel)
+        return results
+    finally:
+        await db.disconnect()
+
+
+def report(results: dict[str, Any]) -> None:
+    print(f"{results['iterations']} queries across {results['guilds']} guilds")
+    for name, r in results.items():
+        if not isinstance(r, dict):
+            continue
+        print(
+            f"  {name:22} p50 {r['p50_ms']:.3f}ms  p99 {r['p99_ms']:.3f}ms"
+            f"  mean {r['mean_ms']:.3f}ms  cpu {r['cpu_us_per_call']:.0f}us/call"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--guilds", type=int, default=200)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+
+if __name__ == "__main__":
+    main()
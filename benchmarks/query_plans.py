@@ -0,0 +1,296 @@
+"""
+Reports the query plans and timings of the queries DatabaseUtils and the generator code run.
+
+Seeds the database in DATABASE_URL with production-scale rows, then runs each query
+under EXPLAIN ANALYZE against randomly chosen rows. Only use a throwaway database:
+seeding refuses to run if there are already guilds, unless --force is given, and
+--compare drops and recreates the lookup indexes to show the plans without them.
+
+    python -m benchmarks.query_plans --seed-rows
+    python -m benchmarks.query_plans --compare --iterations 50
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import random
+from typing import Any
+
+from prisma import Prisma
+
+# (name, SQL, the sample fields for its parameters). Prisma's queries, as they reach the
+# database: includes are a second query on the related table, by the parent's keys
+QUERIES: list[tuple[str, str, tuple[str, ...]]] = [
+    ("guild by id", 'SELECT * FROM "Guild" WHERE "id" = $1', ("guild_id",)),
+    (
+        "guild links (include / raw path)",
+        'SELECT * FROM "Link" WHERE "guildId" = $1',
+        ("guild_id",),
+    ),
+    (
+        "guild links by channel (raw path)",
+        'SELECT * FROM "Link" WHERE "guildId" = $1 AND "id" = ANY($2)',
+        ("guild_id", "link_ids"),
+    ),
+    (
+        "link by id and type",
+        'SELECT * FROM "Link" WHERE "id" = $1 AND "type" = $2::"LinkType" LIMIT 1',
+        ("link_id", "link_type"),
+    ),
+    (
+        "link delete by channel",
+        'SELECT "dbId" FROM "Link" WHERE "id" = $1 AND "guildId" = $2',
+        ("link_id", "guild_id"),
+    ),
+    (
+        "empty links",
+        'SELECT "dbId" FROM "Link" WHERE "linkedRoles" = \'{}\''
+        " AND \"reverseLinkedRoles\" = '{}' AND \"speakerRoles\" = '{}'"
+        ' AND "excludeChannels" = \'{}\' AND "suffix" IS NULL',
+        (),
+    ),
+    (
+        "guild generators",
+        'SELECT * FROM "VoiceGenerator" WHERE "guildId" = $1',
+        ("guild_id",),
+    ),
+    (
+        "generator by channel",
+        'SELECT * FROM "VoiceGenerator" WHERE "guildId" = $1 AND "generatorId" = $2',
+        ("generator_guild_id", "generator_channel_id"),
+    ),
+    (
+        "generator open channels (include)",
+        'SELECT * FROM "GeneratedChannel" WHERE "voiceGeneratorId" = ANY($1)',
+        ("generator_ids",),
+    ),
+    (
+        "generated channel by channel",
+        'SELECT * FROM "GeneratedChannel" WHERE "channelId" = $1',
+        ("channel_id",),
+    ),
+    (
+        "generated channel count",
+        'SELECT COUNT(*) FROM "GeneratedChannel" WHERE "voiceGeneratorId" = $1',
+        ("generator_id",),
+    ),
+    (
+        "warm-up guilds",
+        'SELECT * FROM "Guild" WHERE "id" = ANY($1)',
+        ("guild_batch",),
+    ),
+    (
+        "warm-up links",
+        'SELECT * FROM "Link" WHERE "guildId" = ANY($1)',
+        ("guild_batch",),
+    ),
+    (
+        "warm-up generators",
+        'SELECT * FROM "VoiceGenerator" WHERE "guildId" = ANY($1)',
+        ("guild_batch",),
+    ),
+]
+
+# Named as Prisma names them, so they match the @@index lines `prisma db push` applies
+INDEXES = {
+    "Link_guildId_idx": 'CREATE INDEX "Link_guildId_idx" ON "Link"("guildId")',
+    "GeneratedChannel_voiceGeneratorId_idx": (
+        'CREATE INDEX "GeneratedChannel_voiceGeneratorId_idx"'
+        ' ON "GeneratedChannel"("voiceGeneratorId")'
+    ),
+}
+
+# Snowflake-like IDs, with a different offset for each kind of row
+SEED = [
+    'INSERT INTO "Guild" ("id", "botMasterRoles")'
+    " SELECT (100000000000000000 + g)::text, '{}' FROM generate_series(1, $1::int) g",
+    'INSERT INTO "Link" ("dbId", "id", "type", "guildId", "linkedRoles",'
+    ' "reverseLinkedRoles", "suffix", "speakerRoles", "excludeChannels")'
+    " SELECT 'bench' || l, (300000000000000000 + l)::text,"
+    " (ARRAY['REGULAR', 'REGULAR', 'REGULAR', 'REGULAR', 'REGULAR', 'REGULAR',"
+    " 'REGULAR', 'CATEGORY', 'CATEGORY', 'PERMANENT'])[1 + l % 10]::\"LinkType\","
+    " (100000000000000001 + (l * 7919) % $1::int)::text,"
+    " CASE WHEN l % 20 = 0 THEN '{}'::text[]"
+    " ELSE ARRAY[(200000000000000000 + l % 5000)::text] END,"
+    " CASE WHEN l % 5 = 0 THEN ARRAY[(200000000000000000 + l % 3000)::text]"
+    " ELSE '{}'::text[] END,"
+    " CASE WHEN l % 3 = 0 THEN '[VC]' END, '{}', '{}'"
+    " FROM generate_series(1, $2::int) l",
+    'INSERT INTO "VoiceGenerator" ("id", "guildId", "categoryId", "generatorId",'
+    ' "defaultOptions")'
+    " SELECT 'bench' || v, (100000000000000001 + (v * 104729) % $1::int)::text,"
+    " (400000000000000000 + v)::text, (500000000000000000 + v)::text, '{}'"
+    " FROM generate_series(1, $2::int) v",
+    'INSERT INTO "GeneratedChannel" ("id", "channelId", "ownerId", "voiceGeneratorId")'
+    " SELECT 'bench' || c, (600000000000000000 + c)::text,"
+    " (700000000000000000 + c)::text, 'bench' || (1 + (c * 31) % $1::int)"
+    " FROM generate_series(1, $2::int) c",
+]
+
+
+async def seed(db: Prisma, args: argparse.Namespace) -> None:
+    existing = await db.query_raw('SELECT COUNT(*)::int AS count FROM "Guild"')
+    if existing[0]["count"] and not args.force:
+        raise SystemExit(
+            "The database already has guilds. Use a throwaway database, or --force"
+        )
+
+    guilds = await db.execute_raw(SEED[0], args.guilds)
+    links = await db.execute_raw(SEED[1], args.guilds, args.links)
+    generators = await db.execute_raw(SEED[2], args.guilds, args.generators)
+    channels = await db.execute_raw(SEED[3], args.generators, args.generated_channels)
+    await db.execute_raw("ANALYZE")
+    print(
+        f"Seeded {guilds:,} guilds, {links:,} links, {generators:,} generators"
+        f" and {channels:,} generated channels"
+    )
+
+
+async def samples(db: Prisma, rng: random.Random, count: int) -> list[dict[str, Any]]:
+    """Parameters for each query, from random rows which exist"""
+    links = await db.query_raw(
+        'SELECT "id", "type"::text AS type, "guildId" FROM "Link"'
+        " ORDER BY random() LIMIT $1",
+        count,
+    )
+    generators = await db.query_raw(
+        'SELECT "id", "guildId", "generatorId" FROM "VoiceGenerator"'
+        " ORDER BY random() LIMIT $1",
+        count,
+    )
+    channels = await db.query_raw(
+        'SELECT "channelId" FROM "GeneratedChannel" ORDER BY random() LIMIT $1', count
+    )
+    guilds = await db.query_raw('SELECT "id" FROM "Guild" ORDER BY random() LIMIT 1000')
+    if not (links and generators and channels and guilds):
+        raise SystemExit("The database needs rows in every table. Use --seed-rows")
+
+    guild_ids = [g["id"] for g in guilds]
+    result = []
+    for i in range(count):
+        link = links[i % len(links)]
+        generator = generators[i % len(generators)]
+        result.append(
+            {
+                "guild_id": link["guildId"],
+                "link_id": link["id"],
+                "link_type": link["type"],
+                # The channel, its category and the guild, as get_all_linked_channel asks
+                "link_ids": [
+                    link["id"],
+                    str(rng.randrange(10**17, 10**18)),
+                    link["guildId"],
+                ],
+                "generator_guild_id": generator["guildId"],
+                "generator_channel_id": generator["generatorId"],
+                "generator_id": generator["id"],
+                "generator_ids": [
+                    g["id"] for g in rng.sample(generators, min(3, len(generators)))
+                ],
+                "channel_id": channels[i % len(channels)]["channelId"],
+                "guild_batch": rng.sample(guild_ids, min(100, len(guild_ids))),
+            }
+        )
+    return result
+
+
+def scans(plan: dict[str, Any]) -> set[str]:
+    """The kinds of scan used anywhere in a plan"""
+    found = {plan["Node Type"]} if "Scan" in plan["Node Type"] else set()
+    for child in plan.get("Plans", ()):
+        found |= scans(child)
+    return found
+
+
+async def explain(
+    db: Prisma, params: list[dict[str, Any]], iterations: int
+) -> dict[str, Any]:
+    results: dict[str, Any] = {}
+    for name, sql, fields in QUERIES:
+        planning: list[float] = []
+        execution: list[float] = []
+        used: set[str] = set()
+        for p in params[:iterations]:
+            rows = await db.query_raw(
+                "EXPLAIN (ANALYZE, FORMAT JSON) " + sql, *(p[f] for f in fields)
+            )
+            plan = rows[0]["QUERY PLAN"]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            planning.append(plan[0]["Planning Time"])
+            execution.append(plan[0]["Execution Time"])
+            used |= scans(plan[0]["Plan"])
+
+        execution.sort()
+        results[name] = {
+            "planning_ms": sum(planning) / len(planning),
+            "execution_p50_ms": execution[len(execution) // 2],
+            "execution_max_ms": execution[-1],
+            "scans": sorted(used),
+        }
+    return results
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    db = Prisma()
+    await db.connect()
+    try:
+        if args.seed_rows:
+            await seed(db, args)
+
+        params = await samples(db, random.Random(args.seed), args.iterations)
+        results: dict[str, Any] = {}
+        if args.compare:
+            for index in INDEXES:
+                await db.execute_raw(f'DROP INDEX IF EXISTS "{index}"')
+            await db.execute_raw("ANALYZE")
+            results["without indexes"] = await explain(db, params, args.iterations)
+            for sql in INDEXES.values():
+                await db.execute_raw(sql)
+            await db.execute_raw("ANALYZE")
+        results["with indexes"] = await explain(db, params, args.iterations)
+        return results
+    finally:
+        await db.disconnect()
+
+
+def report(results: dict[str, Any]) -> None:
+    for variant, queries in results.items():
+        print(variant)
+        for name, r in queries.items():
+            print(
+                f"  {name:36} plan {r['planning_ms']:6.3f}ms"
+                f"  exec p50 {r['execution_p50_ms']:8.3f}ms"
+                f"  max {r['execution_max_ms']:8.3f}ms  {', '.join(r['scans'])}"
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--seed-rows", action="store_true", help="seed the database first"
+    )
+    parser.add_argument("--force", action="store_true", help="seed even if not empty")
+    parser.add_argument("--guilds", type=int, default=100_000)
+    parser.add_argument("--links", type=int, default=800_000)
+    parser.add_argument("--generators", type=int, default=40_000)
+    parser.add_argument("--generated-channels", type=int, default=60_000)
+    parser.add_argument(
+        "--compare", action="store_true", help="also run without the lookup indexes"
+    )
+    parser.add_argument("--iterations", type=int, default=20, help="runs per query")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+"""
+Replays join, leave and hop events through the VoiceState cog and reports its throughput.
+
+Events go through `on_voice_state_update` (and so `join`, `leave` and `change`), with
+`process_queues` run every `--flush-every` events, against in-memory stand-ins for the
+database, Redis and Discord's REST API.
+
+    python -m benchmarks.voicestate_load --guilds 50 --members 200 --events 20000
+    python -m benchmarks.voicestate_load --save-trace trace.jsonl
+    python -m benchmarks.voicestate_load --trace trace.jsonl --json
+    python -m benchmarks.voicestate_load --warm-up
+
+A trace is a JSON lines file of `{"g": guild_id, "m": member_id, "b": channel_id, "a": channel_id}`,
+where `b` and `a` are null for joins and leaves.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from typing import Any, Optional
+
+from prisma.enums import LinkType
+from prisma.models import Link
+
+from benchmarks.fakes import (
+    FakeCategory,
+    FakeChannel,
+    FakeClient,
+    FakeGuild,
+    FakeMember,
+    FakePrisma,
+    FakeRedis,
+    FakeRole,
+    FakeVoiceState,
+    RestCounter,
+    fake_database,
+)
+from cogs.voicestate import VoiceState
+
+Event = tuple[int, int, Optional[int], Optional[int]]
+
+
+class World:
+    """Synthetic guilds, with a mix of regular, category, all and permanent links"""
+
+    def __init__(self, rest: RestCounter, rng: random.Random, args: argparse.Namespace):
+        self.rest = rest
+        self.rng = rng
+        self.args = args
+        self.ids = itertools.count(10**17)
+        self.guilds: dict[int, FakeGuild] = {}
+        self.links: dict[str, list[Link]] = {}
+        self.categories: dict[int, list[FakeCategory]] = {}
+
+    def generate(self) -> None:
+        for _ in range(self.args.guilds):
+            guild = self.add_guild(next(self.ids))
+            for _ in range(self.args.channels):
+                self.add_channel(guild, next(self.ids))
+            for _ in range(self.args.members):
+                self.add_member(guild, next(self.ids))
+
+    def add_guild(self, guild_id: int) -> FakeGuild:
+        guild = self.guilds[guild_id] = FakeGuild(guild_id, self.rest)
+        for _ in range(self.args.roles):
+            role = FakeRole(next(self.ids), guild, self.rng.random() > 0.05)
+            guild.roles[role.id] = role
+        self.categories[guild_id] = []
+        for _ in range(3):
+            category = FakeCategory(next(self.ids))
+            self.categories[guild_id].append(category)
+            self.link(guild, category.id, LinkType.CATEGORY, 0.5)
+        self.link(guild, guild_id, LinkType.ALL, 0.5)
+        return guild
+
+    def add_channel(self, guild: FakeGuild, channel_id: int) -> FakeChannel:
+        category = None
+        if self.rng.random() < 0.8:
+            category = self.rng.choice(self.categories[guild.id])
+        channel = guild.channels[channel_id] = FakeChannel(channel_id, guild, category)
+        if not self.link(guild, channel_id, LinkType.PERMANENT, 0.1):
+            self.link(guild, channel_id, LinkType.REGULAR, 0.7)
+        return channel
+
+    def add_member(self, guild: FakeGuild, member_id: int) -> FakeMember:
+        member = guild._members[member_id] = FakeMember(member_id, guild)
+        return member
+
+    def link(
+        self, guild: FakeGuild, target_id: int, link_type: LinkType, chance: float
+    ) -> bool:
+        if self.rng.random() >= chance:
+            return False
+
+        roles = [str(r) for r in guild.roles if r != guild.id]
+        self.links.setdefault(str(guild.id), []).append(
+            Link(
+                dbId=str(next(self.ids)),
+                id=str(target_id),
+                type=link_type,
+                guildId=str(guild.id),
+                linkedRoles=self.rng.sample(roles, self.rng.randint(1, 3)),
+                reverseLinkedRoles=(
+                    self.rng.sample(roles, 1) if self.rng.random() < 0.2 else []
+                ),
+                suffix="[VC]" if self.rng.random() < 0.3 else None,
+                speakerRoles=[],
+                excludeChannels=[],
+            )
+        )
+        return True
+
+    def prepare(self, trace: list[Event]) -> None:
+        """Create any guilds, channels and members in a recorded trace"""
+        for guild_id, member_id, before, after in trace:
+            guild = self.guilds.get(guild_id) or self.add_guild(guild_id)
+            for channel_id in (before, after):
+                if channel_id is not None and channel_id not in guild.channels:
+                    self.add_channel(guild, channel_id)
+            if member_id not in guild._members:
+                self.add_member(guild, member_id)
+
+    def trace(self, events: int) -> list[Event]:
+        """Generate joins, leaves and hops, with each member's channel kept consistent"""
+        members = [(g, m) for g in self.guilds.values() for m in g._members]
+        location: dict[int, int] = {}
+        trace: list[Event] = []
+        while len(trace) < events:
+            guild, member_id = self.rng.choice(members)
+            before = location.get(member_id)
+            if before is None or self.rng.random() < 0.7:
+                after: Optional[int] = self.rng.choice(list(guild.channels))
+                if after == before:
+                    continue
+            else:
+                after = None
+
+            if after is None:
+                del location[member_id]
+            else:
+                location[member_id] = after
+            trace.append((guild.id, member_id, before, after))
+        return trace
+
+    def move(self, event: Event) -> tuple[FakeMember, FakeVoiceState, FakeVoiceState]:
+        """Apply an event to the cached state, as discord.py does before dispatching it"""
+        guild_id, member_id, before_id, after_id = event
+        guild = self.guilds[guild_id]
+        member = guild._members[member_id]
+        before = FakeVoiceState(guild.channels[before_id] if before_id else None)
+        after = FakeVoiceState(guild.channels[after_id] if after_id else None)
+
+        if before.channel is not None:
+            before.channel.voice_states.pop(member_id, None)
+        if after.channel is not None:
+            after.channel.voice_states[member_id] = after
+        member.voice = after if after.channel else None
+        return member, before, after
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def load_trace(path: str) -> list[Event]:
+    with open(path) as f:
+        return [
+            (int(e["g"]), int(e["m"]), e.get("b"), e.get("a"))
+            for e in map(json.loads, f)
+            if e
+        ]
+
+
+def save_trace(path: str, trace: list[Event]) -> None:
+    with open(path, "w") as f:
+        for g, m, b, a in trace:
+            f.write(json.dumps({"g": g, "m": m, "b": b, "a": a}) + "\n")
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    rng = random.Random(args.seed)
+    rest = RestCounter(args.rest_latency)
+    world = World(rest, rng, args)
+
+    if args.trace:
+        trace = load_trace(args.trace)
+        world.prepare(trace)
+    else:
+        world.generate()
+        trace = world.trace(args.events)
+    if args.save_trace:
+        save_trace(args.save_trace, trace)
+
+    prisma = FakePrisma(world.links, args.db_latency)
+    redis = FakeRedis()
+    client = FakeClient(fake_database(prisma), redis, list(world.guilds.values()), rest)
+    client.db.raw_link_queries = args.raw_link_queries
+
+    cog = VoiceState(client)  # type: ignore
+    cog.process_queues.cancel()
+    cog.catch_up.enabled = False
+    # Measure the pipeline itself rather than Discord's member edit rate limit
+    cog.scheduler.rate = 1e9
+    cog.scheduler.burst = 10**9
+
+    warm_up_queries = 0
+    if args.warm_up:
+        client.warm_up.start(0)
+        await client.warm_up.wait(0)
+        # Only count the queries made while handling events
+        warm_up_queries = prisma.total
+        prisma.queries.clear()
+
+    latencies: list[float] = []
+    flush_time = 0.0
+    start = time.perf_counter()
+
+    for i, event in enumerate(trace, 1):
+        member, before, after = world.move(event)
+
+        t = time.perf_counter()
+        await cog.on_voice_state_update(member, before, after)  # type: ignore
+        latencies.append(time.perf_counter() - t)
+
+        if i % args.flush_every == 0:
+            t = time.perf_counter()
+            await cog.process_queues()
+            # Events are normally spread out enough for edits to be sent between flushes
+            await cog.scheduler.join()
+            await client.flush_counters()
+            flush_time += time.perf_counter() - t
+
+    t = time.perf_counter()
+    await cog.process_queues()
+    await cog.scheduler.join()
+    # Let the acknowledgements run
+    await asyncio.sleep(0)
+    await client.flush_counters()
+    flush_time += time.perf_counter() - t
+
+    elapsed = time.perf_counter() - start
+    await cog.logging.stop()
+
+    events = max(len(trace), 1)
+    return {
+        "events": len(trace),
+        "guilds": len(world.guilds),
+        "links": sum(map(len, world.links.values())),
+        "elapsed": elapsed,
+        "events_per_sec": len(trace) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": max(latencies, default=0) * 1000,
+        "flush_ms_per_event": flush_time * 1000 / events,
+        "warm_up_queries": warm_up_queries,
+        "db_queries_per_event": prisma.total / events,
+        "rest_calls_per_event": rest.total / events,
+        "redis_round_trips_per_event": redis.round_trips / events,
+        "edits_sent": cog.scheduler.edit_stats.sent,
+        "unacked_entries": redis.stream_length,
+        "db_queries": dict(prisma.queries.most_common()),
+        "rest_calls": dict(rest.calls.most_common()),
+        "redis_commands": dict(redis.commands.most_common()),
+    }
+
+
+def report(results: dict[str, Any]) -> None:
+    print(
+        f"{results['events']} events across {results['guilds']} guilds"
+        f" with {results['links']} links in {results['elapsed']:.2f}s"
+    )
+    print(f"  events/sec           {results['events_per_sec']:,.0f}")
+    print(
+        f"  handler latency      p50 {results['p50_ms']:.3f}ms"
+        f"  p99 {results['p99_ms']:.3f}ms  max {results['max_ms']:.3f}ms"
+    )
+    print(f"  flush time/event     {results['flush_ms_per_event']:.3f}ms")
+    print(f"  warm-up queries      {results['warm_up_queries']}")
+    print(f"  DB queries/event     {results['db_queries_per_event']:.3f}")
+    print(f"  REST calls/event     {results['rest_calls_per_event']:.3f}")
+    print(f"  Redis trips/event    {results['redis_round_trips_per_event']:.3f}")
+    print(f"  edits sent           {results['edits_sent']}")
+    print(f"  unacked entries      {results['unacked_entries']}")
+    for name in ("db_queries", "rest_calls", "redis_commands"):
+        print(f"  {name}: " + ", ".join(f"{k}={v}" for k, v in results[name].items()))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--guilds", type=int, default=20)
+    parser.add_argument("--channels", type=int, default=15, help="per guild")
+    parser.add_argument("--members", type=int, default=100, help="per guild")
+    parser.add_argument("--roles", type=int, default=30, help="per guild")
+    parser.add_argument("--events", type=int, default=10_000)
+    parser.add_argument("--flush-every", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--db-latency", type=float, default=0.0, help="seconds per query"
+    )
+    parser.add_argument(
+        "--rest-latency", type=float, default=0.0, help="seconds per REST call"
+    )
+    parser.add_argument(
+        "--warm-up", action="store_true", help="warm up the caches before replaying"
+    )
+    parser.add_argument(
+        "--raw-link-queries",
+        action="store_true",
+        help="load links with raw SQL instead of Prisma's include",
+    )
+    parser.add_argument("--trace", help="replay a recorded trace instead")
+    parser.add_argument("--save-trace", help="write the trace that was replayed")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+
+if __name__ == "__main__":
+    main()
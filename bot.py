@@ -25,7 +25,7 @@ ar: aioredis.Redis[Any] = aioredis.Redis(
     db=config.REDIS.DB,
     decode_responses=True,
 )
-db_utils = DatabaseUtils()
+db_utils = DatabaseUtils(ar)
 
 client = VCRolesClient(
     ar, intents=intents, db=db_utils, console_log_level=LogLevel.ERROR
@@ -102,11 +102,11 @@ class AllLink(commands.Cog):
                 "You must be in a server to use this command."
             )
 
-        data = await self.client.db.get_channel_linked(
+        data = await self.client.db.find_channel_linked(
             interaction.guild.id, interaction.guild.id, LinkType.ALL
         )
 
-        if str(role.id) in data.linkedRoles:
+        if data and str(role.id) in data.linkedRoles:
             data.linkedRoles.remove(str(role.id))
 
             await self.client.db.update_channel_linked(
@@ -195,11 +195,11 @@ class AllLink(commands.Cog):
                 "You must be in a server to use this command."
             )
 
-        data = await self.client.db.get_channel_linked(
+        data = await self.client.db.find_channel_linked(
             interaction.guild.id, interaction.guild.id, LinkType.ALL
         )
 
-        if str(channel.id) in data.excludeChannels:
+        if data and str(channel.id) in data.excludeChannels:
             data.excludeChannels.remove(str(channel.id))
 
             await self.client.db.update_channel_linked(
@@ -329,11 +329,11 @@ class AllLink(commands.Cog):
                 "You must be in a server to use this command."
             )
 
-        data = await self.client.db.get_channel_linked(
+        data = await self.client.db.find_channel_linked(
             interaction.guild.id, interaction.guild.id, LinkType.ALL
         )
 
-        if str(role.id) in data.reverseLinkedRoles:
+        if data and str(role.id) in data.reverseLinkedRoles:
             data.reverseLinkedRoles.remove(str(role.id))
 
             await self.client.db.update_channel_linked(
@@ -5,6 +5,7 @@ import discord
 from discord.enums import EntitlementOwnerType
 from discord.ext import commands
 
+from utils.cache import cache_stats
 from utils.client import VCRolesClient
 from utils.types import LogLevel
 
@@ -158,6 +159,131 @@ class Dev(commands.Cog):
         self.client.console_log_level = level
         await ctx.send(f"Set log level to {level.name}")
 
+    @commands.command(aliases=["ms"])
+    @commands.is_owner()
+    async def member_state(self, ctx: commands.Context[Any]):
+        voice_state = self.client.get_cog("VoiceState")
+        tracker = getattr(voice_state, "member_state", None)
+        if tracker is None:
+            return await ctx.send("The VoiceState cog is not loaded.")
+
+        await ctx.send(
+            f"Tracked members: {len(tracker.states):,} | Hits: {tracker.hits:,} | Fetch fallbacks: {tracker.fallbacks:,}"
+        )
+
+    @commands.command(aliases=["eq"])
+    @commands.is_owner()
+    async def edit_queue(self, ctx: commands.Context[Any]):
+        voice_state = self.client.get_cog("VoiceState")
+        scheduler = getattr(voice_state, "scheduler", None)
+        if scheduler is None:
+            return await ctx.send("The VoiceState cog is not loaded.")
+
+        stats = scheduler.stats()
+        await ctx.send(
+            f"Queued: {stats['queued']:,} in {stats['busy_guilds']:,} guilds (max {stats['max_queued']:,}) | Workers: {stats['workers']:,}\n"
+            f"Sent: {stats['sent']:,} | Wait: {stats['avg_wait']:.2f}s avg, {stats['last_wait']:.2f}s last, {stats['max_wait']:.2f}s max\n"
+            f"Retried: {stats['retried']:,} | Permanent failures: {stats['permanent_failures']:,} | Gave up: {stats['gave_up']:,}"
+        )
+
+    @commands.command(aliases=["ef"])
+    @commands.is_owner()
+    async def edit_failures(self, ctx: commands.Context[Any], limit: int = 10):
+        voice_state = self.client.get_cog("VoiceState")
+        scheduler = getattr(voice_state, "scheduler", None)
+        if scheduler is None:
+            return await ctx.send("The VoiceState cog is not loaded.")
+
+        failures = sorted(
+            scheduler.failures.items(),
+            key=lambda x: (x[1].permanent, x[1].gave_up, x[1].retried),
+            reverse=True,
+        )[:limit]
+        if not failures:
+            return await ctx.send("No failed edits.")
+
+        await ctx.send(
+            "Failed edits:\n"
+            + "\n".join(
+                [
+                    f"Guild: {guild_id} | Permanent: {f.permanent:,} | Gave up: {f.gave_up:,} | Retried: {f.retried:,} | Last: {f.last_error[:100]}"
+                    for guild_id, f in failures
+                ]
+            )
+        )
+
+    @commands.command(aliases=["cs"])
+    @commands.is_owner()
+    async def cache_stats(self, ctx: commands.Context[Any]):
+        stats = sorted(cache_stats.items(), key=lambda x: x[1].loads, reverse=True)
+        inv = self.client.db.invalidation_stats
+        if not stats:
+            return await ctx.send("No cached functions have been called.")
+
+        await ctx.send(
+            "Cached functions:\n"
+            + "\n".join(
+                [
+                    f"{name} | L1: {s.hits:,} ({s.l1_ratio:.1%}) | L2: {s.l2_hits:,} ({s.l2_ratio:.1%}) | Loads: {s.loads:,} | Coalesced: {s.coalesced:,} | Errors: {s.errors:,}"
+                    for name, s in stats
+                ]
+            )
+            + f"\nInvalidations | Published: {inv.published:,} | Received: {inv.received:,}"
+            + f" | Lag: {inv.last_lag * 1000:.1f}ms last, {inv.avg_lag * 1000:.1f}ms avg, {inv.max_lag * 1000:.1f}ms max"
+            + f" | Resets: {inv.resets:,}"
+        )
+
+    @commands.command(aliases=["ca"])
+    @commands.is_owner()
+    async def caches(self, ctx: commands.Context[Any]):
+        report = self.client.db.cache_report()
+        manager = self.client.cache_manager
+        await ctx.send(
+            f"Caches: ~{manager.used / 2**20:.1f} MiB used, ~{manager.allocated / 2**20:.1f} MiB when full"
+            + (
+                f", {manager.budget / 2**20:.0f} MiB budget\n"
+                if manager.budget
+                else "\n"
+            )
+            + "\n".join(
+                [
+                    f"{name} | Size: {r['size']:,}/{r['maxsize']:,} | Hits: {r['hits']:,} ({r['hit_ratio']:.1%}) | Misses: {r['misses']:,} | Evictions: {r['evictions']:,} | Expired: {r['expirations']:,} | Load: {r['load_ms_avg']:.1f}ms avg, {r['load_ms_max']:.1f}ms max | ~{manager.caches[name].entry_size:,}B/entry"
+                    for name, r in report.items()
+                ]
+            )
+        )
+
+    @commands.command(aliases=["dbs"])
+    @commands.is_owner()
+    async def database_stats(self, ctx: commands.Context[Any]):
+        db = self.client.db
+        report = db.method_report()
+        pool = await db.pool_report()
+
+        # Split into messages under Discord's length limit
+        paginator = commands.Paginator(prefix=None, suffix=None)
+        paginator.add_line(
+            f"Database calls | In flight: {db.in_flight:,} | Max in flight: {db.max_in_flight:,}"
+        )
+        if pool:
+            paginator.add_line(
+                "Pool | " + " | ".join(f"{k}: {v:,.0f}" for k, v in pool.items())
+            )
+        for name, r in list(report.items())[:20]:
+            paginator.add_line(
+                f"{name} | Calls: {r['calls']:,} | Errors: {r['errors']:,} | Time: {r['ms_avg']:.1f}ms avg, {r['ms_max']:.1f}ms max, {r['ms_total'] / 1000:.1f}s total | In flight: {r['in_flight']:,} ({r['max_in_flight']:,} max)"
+            )
+
+        for page in paginator.pages:
+            await ctx.send(page)
+
+    @commands.command(aliases=["cel"])
+    @commands.is_owner()
+    async def cleanup_empty_links(self, ctx: commands.Context[Any]):
+        await ctx.reply("Deleting empty links...")
+        deleted = await self.client.db.delete_empty_links()
+        await ctx.send(f"Deleted {deleted:,} empty links.")
+
     @commands.command(aliases=["su"])
     @commands.is_owner()
     async def send_update_message(
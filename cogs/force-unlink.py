@@ -33,11 +33,16 @@ class UnLink(commands.Cog):
         await self.client.db.db.link.delete_many(
             where={"id": channel_id, "guildId": str(interaction.guild.id)}
         )
+        await self.client.db.invalidate(
+            *self.client.db.linked_channel_keys(channel_id, interaction.guild.id),
+            ("all_links_cache", interaction.guild.id),
+            ("link_index_cache", interaction.guild.id),
+        )
 
-        data = await self.client.db.get_channel_linked(
+        data = await self.client.db.find_channel_linked(
             interaction.guild.id, interaction.guild.id, LinkType.ALL
         )
-        if channel_id in data.excludeChannels:
+        if data and channel_id in data.excludeChannels:
             data.excludeChannels.remove(channel_id)
             await self.client.db.update_channel_linked(
                 interaction.guild.id,
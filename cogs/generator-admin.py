@@ -17,6 +17,11 @@ class VoiceGen(commands.Cog):
         self.client = client
 
     async def remove_generator(self, data: VoiceGenerator) -> None:
+        # The generator's row is deleted by the caller, so only the channels' links are
+        # left to be cleaned up, and the category's as usual
+        self.client.channel_cleanup.ignore(
+            *filter(None, (data.generatorId, data.interfaceChannel))
+        )
         if data.generatorId:
             try:
                 generator_channel = await self.client.fetch_channel(
@@ -758,9 +763,7 @@ class VoiceGen(commands.Cog):
                 "This command can only be used in a server"
             )
 
-        deleted = await self.client.db.db.voicegenerator.delete_many(
-            where={"guildId": str(interaction.guild.id)}
-        )
+        deleted = await self.client.db.delete_guild_generators(interaction.guild.id)
 
         await interaction.response.send_message(
             f"Deleted {deleted} generator channels from the database"
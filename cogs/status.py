@@ -18,6 +18,22 @@ class Status(commands.Cog):
                 return web.Response(status=503)
             return web.Response(status=200, text="OK")
 
+        @routes.get("/caches")
+        async def caches(request):  # type: ignore
+            return web.json_response(self.client.db.cache_report())
+
+        @routes.get("/database")
+        async def database(request):  # type: ignore
+            db = self.client.db
+            return web.json_response(
+                {
+                    "in_flight": db.in_flight,
+                    "max_in_flight": db.max_in_flight,
+                    "pool": await db.pool_report(),
+                    "methods": db.method_report(),
+                }
+            )
+
         self.webserver_port = WEBSERVER_PORT
         app.add_routes(routes)
 
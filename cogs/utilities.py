@@ -130,7 +130,9 @@ class Utils(commands.Cog):
 
         # create a webhook in the channel and save the webhook url in redis for later use
         webhook = await channel.create_webhook(name="VC Roles")
-        await self.client.ar.hset("webhooks", str(interaction.guild.id), webhook.url)
+        await self.client.db.set_hash_field(
+            "webhooks", interaction.guild.id, webhook.url
+        )
 
         await interaction.response.send_message(
             content=f"Successfully set the update channel to {channel.mention}"
@@ -1,21 +1,34 @@
-import copy
-from typing import Collection, Tuple
+import asyncio
+import time
+from typing import Any, Optional, Union
 
 import discord
-import discord.utils as disutils
 from discord.ext import commands, tasks
-from discord.object import Object
+from redis.exceptions import RedisError
 
 from prisma.enums import LinkType
 from utils.client import VCRolesClient
+from utils.link_index import GuildLinkIndex, ResolvedLinks
 from utils.types import (
+    JoinableChannel,
     LogLevel,
     MentionableRole,
-    SuffixConstructor,
     VoiceStateReturnData,
 )
+from voicestate.catch_up import CatchUp
+from voicestate.durable_queue import DurableEditQueue
 from voicestate.generator import Generator
 from voicestate.logging import Logging
+from voicestate.member_state import MemberState, MemberStateTracker
+from voicestate.reconciler import (
+    ChannelKey,
+    MemberEdit,
+    MemberReconciler,
+    PendingMember,
+    channel_key,
+)
+from voicestate.scheduler import EditJob, EditPriority, EditScheduler
+from voicestate.snapshot import MemberSnapshot, VoiceStateSnapshot
 
 
 class VoiceState(commands.Cog):
@@ -23,76 +36,112 @@ class VoiceState(commands.Cog):
         self.client = client
         self.generator = Generator(client)
         self.logging = Logging(client)
-        self.member_queues: dict[
-            int,
-            list[Tuple[discord.Member, list[discord.Role], list[discord.Role], str]],
-        ] = {}
+        self.member_state = MemberStateTracker()
+        self.reconciler = MemberReconciler()
+        self.scheduler = EditScheduler(
+            client, self.handle_user_edit, self.handle_edit_finished
+        )
+        self.durable_queue = DurableEditQueue(client)
+        self.member_queues: dict[int, dict[int, PendingMember]] = {}
+        self.catch_up = CatchUp(self)
         self.process_queues.start()
 
+        # Only entries from before this point need to be replayed
+        self.replay_until = f"{int(time.time() * 1000)}-0"
+        self.client.loop.create_task(self.replay_durable_queue())
+
     async def cog_unload(self):
+        self.catch_up.stop()
         self.process_queues.cancel()
         await self.logging.stop()
 
-        # Finish processing any remaining member queues
+        # Finish processing any remaining member queues.
+        # Anything left over is still in the durable queue and is replayed on startup.
         await self.process_queues()
+        try:
+            await self.scheduler.join(timeout=10)
+        except asyncio.TimeoutError:
+            pass
 
         await super().cog_unload()
 
     @tasks.loop(seconds=5)
     async def process_queues(self):
+        # Take the member_queues and replace them with an empty one
+        member_queues, self.member_queues = self.member_queues, {}
+
+        for guild_id, queue in member_queues.items():
+            if not queue:
+                continue
+
+            try:
+                await self.process_guild_queue(guild_id, queue)
+            except Exception as e:
+                self.client.log(
+                    LogLevel.ERROR,
+                    f"Error processing member queue for g/{guild_id}: {e}",
+                )
+                self.requeue(guild_id, queue)
+
+        self.scheduler.prune()
+
+    async def process_guild_queue(
+        self, guild_id: int, queue: dict[int, PendingMember]
+    ) -> None:
+        """Reconcile a guild's pending members, removing each from `queue` once done"""
+        guild = self.client.get_guild(guild_id)
+        if not guild:
+            await self.durable_queue.ack(
+                next(iter(queue.values())).member.guild.shard_id,
+                [e for pending in queue.values() for e in pending.entry_ids],
+            )
+            queue.clear()
+            return
+
+        index = await self.client.db.get_link_index(guild_id)
+
+        completed: list[str] = []
         try:
-            # Create a copy of the member_queues and clear the original
-            member_queues = self.member_queues.copy()
-            self.member_queues.clear()
-
-            for guild_id, queue in member_queues.items():
-                if not queue:
-                    continue
-
-                guild = self.client.get_guild(guild_id)
-                if not guild:
-                    continue
-
-                # Group the current queue by member
-                member_changes = {}
-                for member, to_add, to_remove, new_nick in queue:
-                    if member.id not in member_changes:
-                        member_changes[member.id] = {
-                            "member": member,
-                            "to_add": [],
-                            "to_remove": [],
-                            "new_nick": new_nick,
-                        }
-                    member_changes[member.id]["member"] = member
-                    member_changes[member.id]["to_add"].extend(to_add)
-                    member_changes[member.id]["to_remove"].extend(to_remove)
-                    member_changes[member.id]["new_nick"] = new_nick
-
-                for _member_id, change in member_changes.items():
-                    member = change["member"]
-                    to_add = change["to_add"]
-                    to_remove = change["to_remove"]
-                    new_nick = change["new_nick"]
-
-                    # Find the intersection of to_add and to_remove without using sets (since this removes duplicates)
-                    # We need to do this to handle if a user is spam switching between channels
-                    role_idx = 0
-                    while role_idx < len(to_add):
-                        role = to_add[role_idx]
-                        if role in to_remove:
-                            to_add.pop(role_idx)
-                            to_remove.remove(role)
-                        else:
-                            role_idx += 1
-
-                    # Create a task for handling user edit
-                    self.client.loop.create_task(
-                        self.handle_user_edit(
-                            member, set(to_add), set(to_remove), new_nick
-                        )
+            for member_id, pending in list(queue.items()):
+                state = self.member_state.update(pending.member)
+                edit = self.reconciler.reconcile(guild, index, pending, state)
+                # A queued job would still apply the moves before these, such as the
+                # join before a leave, so it's replaced even if nothing differs
+                if edit is None and not self.scheduler.has_job(pending.member):
+                    completed.extend(pending.entry_ids)
+                else:
+                    self.scheduler.submit(
+                        pending.member,
+                        edit,
+                        self.get_edit_priority(pending, edit),
+                        pending.entry_ids,
+                        pending,
                     )
-        except Exception as e:
-            self.client.log(LogLevel.ERROR, f"Error processing member queues: {e}")
+                del queue[member_id]
+        finally:
+            await self.durable_queue.ack(guild.shard_id, completed)
+
+    def requeue(self, guild_id: int, queue: dict[int, PendingMember]) -> None:
+        """Keep pending members for the next flush, with any moves made since"""
+        member_queue = self.member_queues.setdefault(guild_id, {})
+        for member_id, pending in queue.items():
+            newer = member_queue.get(member_id)
+            if newer is None:
+                member_queue[member_id] = pending
+                continue
+
+            newer.absorb(pending)
+            newer.entry_ids = pending.entry_ids + newer.entry_ids
+
+    @staticmethod
+    def get_edit_priority(
+        pending: PendingMember, edit: Optional[MemberEdit]
+    ) -> EditPriority:
+        if edit is not None and edit.roles is None:
+            return EditPriority.NICKNAME
+        if pending.current is None or not pending.left:
+            return EditPriority.MEMBERSHIP
+        return EditPriority.CHANGE
 
     @process_queues.before_loop
     async def before_process_queues(self):
@@ -100,17 +149,132 @@ class VoiceState(commands.Cog):
 
     async def queue_member_update(
         self,
-        member: discord.Member,
-        to_add: list[discord.Role],
-        to_remove: list[discord.Role],
-        new_nick: str,
+        member: MemberSnapshot,
+        before: Optional[JoinableChannel],
+        after: Optional[JoinableChannel],
     ):
-        if member.guild.id not in self.member_queues:
-            self.member_queues[member.guild.id] = []
-        self.member_queues[member.guild.id].append(
-            (member, to_add, to_remove, new_nick)
+        """Mark a member as needing their roles reconciled at the next flush"""
+        before_key, after_key = channel_key(before), channel_key(after)
+        entry_id: Optional[str] = None
+        # Persisting the move and tracking the member share a round trip
+        try:
+            async with self.client.ar.pipeline(transaction=False) as pipe:
+                self.durable_queue.add(pipe, member, before_key, after_key)
+                self.catch_up.track(pipe, member, before_key, after_key)
+                entry_id = (await pipe.execute())[0]
+        except RedisError as e:
+            self.client.log(LogLevel.ERROR, f"Failed to persist voice edit: {e}")
+        self.mark_pending(member, before_key, after_key, entry_id)
+
+    def mark_pending(
+        self,
+        member: MemberSnapshot,
+        before: Optional[ChannelKey],
+        after: Optional[ChannelKey],
+        entry_id: Optional[str] = None,
+    ) -> None:
+        queue = self.member_queues.setdefault(member.guild.id, {})
+        pending = queue.get(member.id)
+        if pending is None:
+            pending = queue[member.id] = PendingMember(member)
+        pending.member = member
+        pending.move(before, after)
+        if entry_id is not None:
+            pending.entry_ids.append(entry_id)
+
+    def handle_edit_finished(self, job: EditJob) -> None:
+        self.client.loop.create_task(
+            self.durable_queue.ack(job.member.guild.shard_id, job.entry_ids)
         )
 
+    async def replay_durable_queue(self):
+        """Reconcile any members whose edits were lost when the bot last stopped"""
+        await self.client.wait_until_ready()
+
+        replayed = 0
+        for shard_id in self.client.shards:
+            try:
+                async for entry in self.durable_queue.replay(
+                    shard_id, self.replay_until
+                ):
+                    guild = self.client.get_guild(entry.guild_id)
+                    member = guild.get_member(entry.member_id) if guild else None
+                    if guild and not member:
+                        try:
+                            member = await guild.fetch_member(entry.member_id)
+                        except discord.NotFound:
+                            pass
+                        except discord.HTTPException:
+                            # Leave it in the queue to try again next time
+                            continue
+
+                    if not member:
+                        await self.durable_queue.ack(shard_id, [entry.entry_id])
+                        continue
+
+                    self.mark_pending(
+                        MemberSnapshot(member),
+                        entry.before,
+                        entry.after,
+                        entry.entry_id,
+                    )
+                    replayed += 1
+            except RedisError as e:
+                self.client.log(
+                    LogLevel.ERROR, f"Failed to replay voice edits s/{shard_id}: {e}"
+                )
+
+        if replayed:
+            self.client.log(LogLevel.INFO, f"Replayed {replayed} voice edits")
+
+    @commands.Cog.listener()
+    async def on_shard_ready(self, shard_id: int):
+        # Voice events are missed while a shard is disconnected without resuming
+        self.catch_up.start(shard_id)
+
+    @commands.Cog.listener()
+    async def on_shard_resumed(self, shard_id: int):
+        self.catch_up.start(shard_id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
+        # Moving or changing a role can change which roles the bot can assign
+        self.reconciler.invalidate_roles(after.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role: discord.Role):
+        self.reconciler.invalidate_roles(role.guild.id)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        # The bot's top role decides which roles it can assign
+        if self.client.user and after.id == self.client.user.id:
+            if before._roles != after._roles:
+                self.reconciler.invalidate_roles(after.guild.id)
+
+    async def get_member_state(
+        self, member: Union[discord.Member, MemberSnapshot], fetch: bool = True
+    ) -> MemberState:
+        """
+        Get the current nickname and roles of a member from the tracker.
+        If they aren't tracked, they are fetched (or taken from `member` if `fetch` is False).
+        Used by catch-up, where the cached member may be older than what is tracked.
+        """
+        state = self.member_state.get(member.guild.id, member.id)
+        if state is not None:
+            return state
+
+        if fetch:
+            self.member_state.fallbacks += 1
+            try:
+                return self.member_state.update(
+                    await member.guild.fetch_member(member.id)
+                )
+            except Exception:
+                pass
+
+        return self.member_state.update(member)
+
     @commands.Cog.listener()
     async def on_voice_state_update(
         self,
@@ -121,14 +285,29 @@ class VoiceState(commands.Cog):
         if member.bot:
             return
 
-        # Make copies of member, before and after to prevent race conditions
-        member = copy.copy(member)
-        before = copy.copy(before)
-        after = copy.copy(after)
+        # Snapshot member, before and after to prevent race conditions.
+        # The generator still needs the member itself.
+        snapshot = MemberSnapshot(member)
+        before_snapshot = VoiceStateSnapshot(before)
+        after_snapshot = VoiceStateSnapshot(after)
+        await self.handle_voice_state_update(
+            member, snapshot, before_snapshot, after_snapshot
+        )
+
+    async def handle_voice_state_update(
+        self,
+        real_member: discord.Member,
+        member: MemberSnapshot,
+        before: VoiceStateSnapshot,
+        after: VoiceStateSnapshot,
+    ):
+        # The event's roles and nickname are newer than anything tracked before it,
+        # including changes made by moderators or other bots
+        self.member_state.update(member)
 
         # Joining
         if before.channel is None and after.channel is not None:
-            roles_changed, failed_roles = await self.join(member, after)
+            roles_changed, failed_roles = await self.join(real_member, member, after)
 
             if failed_roles:
                 self.client.log(
@@ -145,7 +324,7 @@ class VoiceState(commands.Cog):
 
         # Leaving
         elif before.channel is not None and after.channel is None:
-            roles_changed, failed_roles = await self.leave(member, before)
+            roles_changed, failed_roles = await self.leave(real_member, member, before)
 
             if failed_roles:
                 self.client.log(
@@ -167,7 +346,7 @@ class VoiceState(commands.Cog):
             and before.channel != after.channel
         ):
             leave_roles_changed, join_roles_changed, failed_roles = await self.change(
-                member, before, after
+                real_member, member, before, after
             )
 
             if failed_roles:
@@ -192,17 +371,17 @@ class VoiceState(commands.Cog):
         ):
             # Become Speaker
             if before.suppress and not after.suppress:
-                data = await self.client.db.get_channel_linked(
+                data = await self.client.db.find_channel_linked(
                     before.channel.id, member.guild.id, LinkType.STAGE
                 )
 
-                for role_id in data.speakerRoles:
+                for role_id in data.speakerRoles if data else []:
                     role = member.guild.get_role(int(role_id))
                     if not role:
                         continue
 
                     try:
-                        await member.add_roles(role, reason="Became Speaker")
+                        await real_member.add_roles(role, reason="Became Speaker")
                     except discord.errors.Forbidden:
                         pass
                     except discord.errors.HTTPException:
@@ -210,253 +389,164 @@ class VoiceState(commands.Cog):
 
             # Stop Speaker
             elif not before.suppress and after.suppress:
-                data = await self.client.db.get_channel_linked(
+                data = await self.client.db.find_channel_linked(
                     before.channel.id, member.guild.id, LinkType.STAGE
                 )
 
-                for role_id in data.speakerRoles:
+                for role_id in data.speakerRoles if data else []:
                     role = member.guild.get_role(int(role_id))
                     if not role:
                         continue
 
                     try:
-                        await member.remove_roles(role, reason="Stopped Speaker")
+                        await real_member.remove_roles(role, reason="Stopped Speaker")
                     except discord.errors.Forbidden:
                         pass
                     except discord.errors.HTTPException:
                         pass
 
-    async def handle_user_edit(
-        self,
-        member: discord.Member,
-        to_add: Collection[discord.abc.Snowflake],
-        to_remove: Collection[discord.abc.Snowflake],
-        new_user_nickname: str,
-    ):
-        new_roles = disutils.MISSING
+    async def reconcile_job(
+        self, guild: discord.Guild, job: EditJob
+    ) -> Optional[MemberEdit]:
+        """The edit a queued member needs now, from their newest tracked state"""
+        member = job.member
+        index = await self.client.db.get_link_index(guild.id)
+        state = self.member_state.get(guild.id, member.id)
+        if state is None:
+            state = self.member_state.update(member)
+
+        if job.pending is not None:
+            return self.reconciler.reconcile(guild, index, job.pending, state)
+
+        voice = guild._voice_state_for(member.id)
+        current = channel_key(voice.channel) if voice else None
+        return self.reconciler.catch_up(guild, index, member.id, state, current)
+
+    async def handle_user_edit(self, job: EditJob):
+        member = job.member
+        guild = self.client.get_guild(member.guild.id)
+        if guild is None:
+            return
 
-        if to_add or to_remove:
-            new_roles = disutils._unique(  # type: ignore[reportPrivateUsage]
-                Object(id=r.id)
-                for s in (member.roles[1:], to_add)  # remove @everyone
-                for r in s
-            )
+        # Reconciled again, since the member may have changed while the job waited in
+        # the queue or for a retry, and the edit replaces their whole role list
+        edit = await self.reconcile_job(guild, job)
+        if edit is None:
+            return
+        job.edit = edit
 
-            for remove_role in to_remove:
-                try:
-                    new_roles.remove(Object(id=remove_role.id))
-                except ValueError:
-                    pass
+        fields: dict[str, Any] = {}
+        if edit.nick is not None:
+            fields["nick"] = edit.nick
+        if edit.roles is not None:
+            fields["roles"] = edit.roles
 
-        new_nick = disutils.MISSING
+        # Edit through the HTTP client directly, since only a snapshot of the member is kept
+        payload = await self.client.http.edit_member(
+            member.guild.id, member.id, reason="Joined Voice Channel", **fields
+        )
+        self.member_state.update_from_payload(member.guild.id, member.id, payload)
 
-        if new_user_nickname != member.display_name:
-            new_nick = new_user_nickname
+        self.client.incr_role_counter("added", edit.added)
+        self.client.incr_role_counter("removed", edit.removed)
 
-        if member.guild.owner_id == member.id:
-            # The owner can't have their nickname changed
-            new_nick = disutils.MISSING
+    def get_failed_roles(
+        self, guild: discord.Guild, index: GuildLinkIndex, mask: int
+    ) -> list[discord.Role]:
+        """Get the roles in a bitset which exist but can't be assigned by the bot"""
+        unassignable = self.reconciler.get_role_masks(guild, index).unassignable & mask
+        if not unassignable:
+            return []
 
-        try:
-            await member.edit(
-                nick=new_nick,
-                roles=new_roles,
-                reason="Joined Voice Channel",
+        failed_roles: list[discord.Role] = []
+        for role_id in index.roles.role_ids(unassignable):
+            role = guild.get_role(role_id)
+            if role:
+                failed_roles.append(role)
+        return failed_roles
+
+    @staticmethod
+    def join_return_data(resolved: ResolvedLinks) -> list[VoiceStateReturnData]:
+        return [
+            VoiceStateReturnData(
+                "join",
+                link.type,
+                list(map(MentionableRole, link.linked_roles)),
+                list(map(MentionableRole, link.reverse_linked_roles)),
             )
-        except Exception as e:
-            self.client.log(
-                LogLevel.INFO,
-                f"Failed to edit member {member.id} ({member.display_name}): {e}",
+            for link in resolved.links
+        ]
+
+    @staticmethod
+    def leave_return_data(resolved: ResolvedLinks) -> list[VoiceStateReturnData]:
+        return [
+            VoiceStateReturnData(
+                "leave",
+                link.type,
+                list(map(MentionableRole, link.reverse_linked_roles)),
+                list(map(MentionableRole, link.linked_roles)),
             )
+            for link in resolved.leave_links
+        ]
 
     async def join(
         self,
-        member: discord.Member,
-        after: discord.VoiceState,
+        real_member: discord.Member,
+        member: MemberSnapshot,
+        after: VoiceStateSnapshot,
     ) -> tuple[list[VoiceStateReturnData], list[discord.Role]]:
         if not after.channel:
             # Unreachable.
             return [], []
 
-        links = await self.client.db.get_all_linked_channel(
-            member.guild.id,
+        index = await self.client.db.get_link_index(member.guild.id)
+        resolved = index.resolve(
             after.channel.id,
             after.channel.category.id if after.channel.category else None,
         )
 
-        addable_roles: list[str] = []
-        removeable_roles: list[str] = []
-
-        return_data: list[VoiceStateReturnData] = []
-        suffix_data = SuffixConstructor()
-
-        for link in links:
-            if str(after.channel.id) in link.excludeChannels:
-                continue
-            addable_roles.extend(link.linkedRoles)
-            removeable_roles.extend(link.reverseLinkedRoles)
-            return_data.append(
-                VoiceStateReturnData(
-                    "join",
-                    link.type,
-                    list(map(MentionableRole, link.linkedRoles)),
-                    list(map(MentionableRole, link.reverseLinkedRoles)),
-                )
-            )
-            suffix_data.add(link.type, link.suffix or "")
-
-        # remove duplicates
-        addable_roles = list(set(addable_roles))
-        removeable_roles = list(set(removeable_roles))
-
-        # if a role appears in both lists, remove both instances
-        for role in addable_roles:
-            if role in removeable_roles:
-                addable_roles.remove(role)
-                removeable_roles.remove(role)
-
-        failed_roles: list[discord.Role] = []
-
-        to_add: list[discord.Role] = []
-        to_remove: list[discord.Role] = []
-
-        for role_id in addable_roles:
-            role = member.guild.get_role(int(role_id))
-            if not role:
-                continue
-
-            if not role.is_assignable():
-                failed_roles.append(role)
-                continue
-
-            to_add.append(role)
-
-        for role_id in removeable_roles:
-            role = member.guild.get_role(int(role_id))
-            if not role:
-                continue
-
-            if not role.is_assignable():
-                failed_roles.append(role)
-                continue
-
-            to_remove.append(role)
-
-        addable_suffix = f"{suffix_data.permanent_suffix + ' ' if suffix_data.permanent_suffix else ''}{suffix_data.suffix}"
-        if not member.display_name.endswith(addable_suffix):
-            new_user_nickname = f"{member.display_name} {addable_suffix}"
-            if len(new_user_nickname) > 32:
-                new_user_nickname = member.display_name
-        else:
-            new_user_nickname = member.display_name
-
-        await self.queue_member_update(member, to_add, to_remove, new_user_nickname)
+        failed_roles = self.get_failed_roles(
+            member.guild, index, resolved.join_add | resolved.join_remove
+        )
 
-        self.client.incr_role_counter("added", len(addable_roles))
-        self.client.incr_role_counter("removed", len(removeable_roles))
+        await self.queue_member_update(member, None, after.channel)
 
-        await self.generator.join(member, after.channel)
+        await self.generator.join(real_member, after.channel)
 
-        return return_data, list(set(failed_roles))
+        return self.join_return_data(resolved), failed_roles
 
     async def leave(
         self,
-        member: discord.Member,
-        before: discord.VoiceState,
+        real_member: discord.Member,
+        member: MemberSnapshot,
+        before: VoiceStateSnapshot,
     ) -> tuple[list[VoiceStateReturnData], list[discord.Role]]:
         if not before.channel:
             # Unreachable.
             return [], []
 
-        links = await self.client.db.get_all_linked_channel(
-            member.guild.id,
+        index = await self.client.db.get_link_index(member.guild.id)
+        resolved = index.resolve(
             before.channel.id,
             before.channel.category.id if before.channel.category else None,
         )
 
-        addable_roles: list[str] = []
-        removeable_roles: list[str] = []
-
-        return_data: list[VoiceStateReturnData] = []
-        suffix_data = SuffixConstructor()
-
-        for link in links:
-            if str(before.channel.id) in link.excludeChannels:
-                continue
-            if link.type == LinkType.PERMANENT:
-                continue
-            addable_roles.extend(link.reverseLinkedRoles)
-            removeable_roles.extend(link.linkedRoles)
-            return_data.append(
-                VoiceStateReturnData(
-                    "leave",
-                    link.type,
-                    list(map(MentionableRole, link.reverseLinkedRoles)),
-                    list(map(MentionableRole, link.linkedRoles)),
-                )
-            )
-            suffix_data.add(link.type, link.suffix or "")
-
-        # remove duplicates
-        addable_roles = list(set(addable_roles))
-        removeable_roles = list(set(removeable_roles))
-
-        # if a role appears in both lists, remove both instances
-        for role in addable_roles:
-            if role in removeable_roles:
-                addable_roles.remove(role)
-                removeable_roles.remove(role)
-
-        failed_roles: list[discord.Role] = []
-
-        try:
-            fetched_member = await before.channel.guild.fetch_member(member.id)
-        except Exception:
-            fetched_member = member
-
-        to_add: list[discord.Role] = []
-        to_remove: list[discord.Role] = []
-
-        for role_id in addable_roles:
-            role = member.guild.get_role(int(role_id))
-            if not role:
-                continue
-
-            if not role.is_assignable():
-                failed_roles.append(role)
-                continue
-
-            to_add.append(role)
-
-        for role_id in removeable_roles:
-            role = member.guild.get_role(int(role_id))
-            if not role:
-                continue
-
-            if not role.is_assignable():
-                failed_roles.append(role)
-                continue
-
-            to_remove.append(role)
-
-        new_user_nickname = fetched_member.display_name.removesuffix(suffix_data.suffix)
-
-        await self.queue_member_update(
-            fetched_member, to_add, to_remove, new_user_nickname
+        failed_roles = self.get_failed_roles(
+            member.guild, index, resolved.leave_add | resolved.leave_remove
         )
 
-        self.client.incr_role_counter("added", len(addable_roles))
-        self.client.incr_role_counter("removed", len(removeable_roles))
+        await self.queue_member_update(member, before.channel, None)
 
-        await self.generator.leave(member, before.channel)
+        await self.generator.leave(real_member, before.channel)
 
-        return return_data, list(set(failed_roles))
+        return self.leave_return_data(resolved), failed_roles
 
     async def change(
         self,
-        member: discord.Member,
-        before: discord.VoiceState,
-        after: discord.VoiceState,
+        real_member: discord.Member,
+        member: MemberSnapshot,
+        before: VoiceStateSnapshot,
+        after: VoiceStateSnapshot,
     ) -> tuple[
         list[VoiceStateReturnData], list[VoiceStateReturnData], list[discord.Role]
     ]:
@@ -464,124 +554,31 @@ class VoiceState(commands.Cog):
             # Unreachable.
             return [], [], []
 
-        before_links = await self.client.db.get_all_linked_channel(
-            member.guild.id,
+        index = await self.client.db.get_link_index(member.guild.id)
+        before_resolved = index.resolve(
             before.channel.id,
             before.channel.category.id if before.channel.category else None,
         )
-
-        after_links = await self.client.db.get_all_linked_channel(
-            member.guild.id,
+        after_resolved = index.resolve(
             after.channel.id,
             after.channel.category.id if after.channel.category else None,
         )
 
-        addable_roles: list[str] = []
-        removeable_roles: list[str] = []
-
-        leave_return_data: list[VoiceStateReturnData] = []
-        join_return_data: list[VoiceStateReturnData] = []
-
-        leave_suffix_data = SuffixConstructor()
-        join_suffix_data = SuffixConstructor()
-
-        for link in before_links:
-            if str(before.channel.id) in link.excludeChannels:
-                continue
-            if link.type == LinkType.PERMANENT:
-                continue
-            addable_roles.extend(link.reverseLinkedRoles)
-            removeable_roles.extend(link.linkedRoles)
-            leave_return_data.append(
-                VoiceStateReturnData(
-                    "leave",
-                    link.type,
-                    list(map(MentionableRole, link.reverseLinkedRoles)),
-                    list(map(MentionableRole, link.linkedRoles)),
-                )
-            )
-            leave_suffix_data.add(link.type, link.suffix or "")
-
-        for link in after_links:
-            if str(after.channel.id) in link.excludeChannels:
-                continue
-            addable_roles.extend(link.linkedRoles)
-            removeable_roles.extend(link.reverseLinkedRoles)
-            join_return_data.append(
-                VoiceStateReturnData(
-                    "join",
-                    link.type,
-                    list(map(MentionableRole, link.linkedRoles)),
-                    list(map(MentionableRole, link.reverseLinkedRoles)),
-                )
-            )
-            join_suffix_data.add(link.type, link.suffix or "")
-
-        # remove duplicates
-        addable_roles = list(set(addable_roles))
-        removeable_roles = list(set(removeable_roles))
-
-        # if a role appears in both lists, remove both instances
-        for role in addable_roles:
-            if role in removeable_roles:
-                addable_roles.remove(role)
-                removeable_roles.remove(role)
-
-        failed_roles: list[discord.Role] = []
-
-        try:
-            fetched_member = await before.channel.guild.fetch_member(member.id)
-        except Exception:
-            fetched_member = member
-
-        to_add: list[discord.Role] = []
-        to_remove: list[discord.Role] = []
-
-        for role_id in addable_roles:
-            role = member.guild.get_role(int(role_id))
-            if not role:
-                continue
-
-            if not role.is_assignable():
-                failed_roles.append(role)
-                continue
-
-            to_add.append(role)
-
-        for role_id in removeable_roles:
-            role = member.guild.get_role(int(role_id))
-            if not role:
-                continue
-
-            if not role.is_assignable():
-                failed_roles.append(role)
-                continue
-
-            to_remove.append(role)
-
-        removed_leave_suffix = fetched_member.display_name.removesuffix(
-            leave_suffix_data.suffix
-        )
-        addable_suffix = f" {join_suffix_data.permanent_suffix + ' ' if join_suffix_data.permanent_suffix else ''}{join_suffix_data.suffix}"
-        if len(removed_leave_suffix + addable_suffix) > 32:
-            new_user_nickname = removed_leave_suffix
-        else:
-            if not removed_leave_suffix.endswith(addable_suffix):
-                new_user_nickname = removed_leave_suffix + addable_suffix
-            else:
-                new_user_nickname = removed_leave_suffix
-
-        await self.queue_member_update(
-            fetched_member, to_add, to_remove, new_user_nickname
+        add, remove = self.reconciler.desired_roles(
+            [before_resolved], [after_resolved], after_resolved
         )
+        failed_roles = self.get_failed_roles(member.guild, index, add | remove)
 
-        self.client.incr_role_counter("added", len(addable_roles))
-        self.client.incr_role_counter("removed", len(removeable_roles))
+        await self.queue_member_update(member, before.channel, after.channel)
 
-        await self.generator.leave(member, before.channel)
-        await self.generator.join(member, after.channel)
+        await self.generator.leave(real_member, before.channel)
+        await self.generator.join(real_member, after.channel)
 
-        return leave_return_data, join_return_data, list(set(failed_roles))
+        return (
+            self.leave_return_data(before_resolved),
+            self.join_return_data(after_resolved),
+            failed_roles,
+        )
 
 
 async def setup(client: VCRolesClient):
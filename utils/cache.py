@@ -0,0 +1,305 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import inspect
+import itertools
+import time
+from collections import OrderedDict
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Iterable,
+    MutableMapping,
+    Optional,
+    TypeVar,
+    Union,
+)
+
+from cachetools import TTLCache
+from cachetools.keys import hashkey
+
+if TYPE_CHECKING:
+    from utils.shared_cache import SharedCache
+
+T = TypeVar("T")
+
+# Returned by a shared cache when a key isn't cached, as None can be cached
+MISSING: Any = object()
+
+
+class SingleFlightStats:
+    """Counts of the loads made by a cached function, and the callers who shared them"""
+
+    __slots__ = (
+        "hits",
+        "loads",
+        "coalesced",
+        "errors",
+        "l2_hits",
+        "l2_misses",
+        "load_time",
+        "max_load_time",
+    )
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.loads = 0
+        self.coalesced = 0
+        self.errors = 0
+        # Lookups in the shared cache, after a miss in this process
+        self.l2_hits = 0
+        self.l2_misses = 0
+        # Seconds spent loading, from the shared cache or the function
+        self.load_time = 0.0
+        self.max_load_time = 0.0
+
+    @property
+    def misses(self) -> int:
+        return self.coalesced + self.l2_hits + self.loads
+
+    @property
+    def l1_ratio(self) -> float:
+        return self.hits / max(self.hits + self.misses, 1)
+
+    @property
+    def l2_ratio(self) -> float:
+        return self.l2_hits / max(self.l2_hits + self.l2_misses, 1)
+
+    @property
+    def avg_load_time(self) -> float:
+        return self.load_time / max(self.l2_hits + self.loads, 1)
+
+    def record_load(self, duration: float) -> None:
+        self.load_time += duration
+        self.max_load_time = max(self.max_load_time, duration)
+
+
+class InstrumentedTTLCache(TTLCache[Any, Any]):
+    """
+    A TTLCache which counts its hits, the entries it evicts to make room and those which
+    expire. It remembers the keys of recently evicted entries, so a miss which a larger
+    cache would have hit is counted as a ghost hit.
+    """
+
+    def __init__(self, maxsize: float, ttl: float) -> None:
+        super().__init__(maxsize, ttl)
+        self.hits = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.ghost_hits = 0
+        self.ghosts: OrderedDict[Any, None] = OrderedDict()
+
+    @property
+    def ghost_capacity(self) -> int:
+        return max(int(self.maxsize) // 4, 64)
+
+    def __getitem__(self, key: Any) -> Any:
+        value = super().__getitem__(key)
+        self.hits += 1
+        return value
+
+    def pop(self, key: Any, default: Any = MISSING) -> Any:
+        # Cache.pop uses self[key], which isn't a hit
+        if key in self:
+            value = TTLCache.__getitem__(self, key)
+            del self[key]
+            return value
+        if default is MISSING:
+            raise KeyError(key)
+        return default
+
+    def __missing__(self, key: Any) -> Any:
+        if self.ghosts.pop(key, MISSING) is not MISSING:
+            self.ghost_hits += 1
+        raise KeyError(key)
+
+    def popitem(self) -> tuple[Any, Any]:
+        item = super().popitem()
+        self.evictions += 1
+        self.ghosts[item[0]] = None
+        if len(self.ghosts) > self.ghost_capacity:
+            self.ghosts.popitem(last=False)
+        return item
+
+    def expire(self, time: Any = None) -> list[tuple[Any, Any]]:
+        expired = list(super().expire(time))
+        self.expirations += len(expired)
+        return expired
+
+    def sample(self, count: int) -> list[tuple[Any, Any]]:
+        """Up to `count` entries, without counting them as hits"""
+        items: list[tuple[Any, Any]] = []
+        for key in list(itertools.islice(self, count)):
+            try:
+                items.append((key, TTLCache.__getitem__(self, key)))
+            except KeyError:
+                # Expired
+                pass
+        return items
+
+    def resize(self, maxsize: int) -> None:
+        """Change the maximum size, evicting the least recently used entries if it shrinks"""
+        self._Cache__maxsize = maxsize  # type: ignore
+        while self.currsize > maxsize:
+            self.popitem()
+
+
+# The stats of every cached function, by qualified name
+cache_stats: dict[str, SingleFlightStats] = {}
+
+# The loads in progress for each cache, by the cache's id
+cache_loads: dict[int, dict[Any, Union[asyncio.Task[Any], Reservation]]] = {}
+
+
+def evict(cache: MutableMapping[Any, Any], k: Any) -> None:
+    """
+    Remove a key from a cache. A load of the key already in progress may have read the
+    old value, so it is dropped: it still returns to its callers, but isn't stored.
+    """
+    cache.pop(k, None)
+    in_flight = cache_loads.get(id(cache))
+    if in_flight:
+        in_flight.pop(k, None)
+
+
+class Reservation:
+    """
+    Marks keys as being loaded by something other than a cached function, such as a
+    batch query. A value is only stored if its key wasn't evicted or loaded again
+    since it was reserved, just as a cached function's load is.
+    """
+
+    def __init__(self, cache: MutableMapping[Any, Any], keys: Iterable[Any]) -> None:
+        self.cache = cache
+        self.in_flight = cache_loads.setdefault(id(cache), {})
+        # Keys already being loaded are left to that load
+        self.keys = [k for k in keys if self.in_flight.setdefault(k, self) is self]
+
+    def store(self, k: Any, value: Any) -> None:
+        if self.in_flight.get(k) is not self:
+            return
+
+        del self.in_flight[k]
+        try:
+            self.cache[k] = value
+        except ValueError:
+            # Too large for the cache
+            pass
+
+    def release(self) -> None:
+        """Give up the keys which weren't stored"""
+        for k in self.keys:
+            if self.in_flight.get(k) is self:
+                del self.in_flight[k]
+
+
+def cached(
+    cache: MutableMapping[Any, Any],
+    key: Callable[..., Any] = hashkey,
+    shared: Optional[str] = None,
+) -> Callable[[Callable[..., Awaitable[T]]], Callable[..., Awaitable[T]]]:
+    """
+    Cache the results of a coroutine function, like asyncache's `cached`.
+
+    Concurrent misses for the same key share a single load: the first caller starts it,
+    and everyone else awaits the same task. The load runs in its own task, so cancelling
+    one caller doesn't cancel it for the others. Exceptions are passed to every waiter
+    and aren't cached.
+
+    If `shared` is set, a method's misses are looked up in its instance's `shared_cache`
+    under that name before loading, and loaded values are added to it.
+
+    Keys must be removed with `evict`, so a load which started before the key was
+    removed doesn't store the old value afterwards.
+    """
+
+    def decorator(func: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+        stats = cache_stats.setdefault(func.__qualname__, SingleFlightStats())
+        in_flight = cache_loads.setdefault(id(cache), {})
+        signature = inspect.signature(func)
+
+        def current(k: Any) -> bool:
+            """Whether the running load is still the key's, rather than evicted"""
+            return in_flight.get(k) is asyncio.current_task()
+
+        def store(k: Any, value: T) -> None:
+            if not current(k):
+                return
+            try:
+                cache[k] = value
+            except ValueError:
+                # Too large for the cache
+                pass
+
+        async def load(k: Any, args: Any, kwargs: Any) -> T:
+            start = time.perf_counter()
+            shared_cache: Optional[SharedCache] = None
+            if shared and args:
+                shared_cache = getattr(args[0], "shared_cache", None)
+
+            if shared and shared_cache is not None:
+                # Defaults are included, so every call for the same record shares a key
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                shared_key = shared_cache.key(
+                    shared, list(bound.arguments.values())[1:]
+                )
+
+                value = await shared_cache.get(shared, shared_key)
+                if value is not MISSING:
+                    stats.l2_hits += 1
+                    store(k, value)
+                    stats.record_load(time.perf_counter() - start)
+                    return value
+                stats.l2_misses += 1
+
+            stats.loads += 1
+            try:
+                value = await func(*args, **kwargs)
+            except Exception:
+                stats.errors += 1
+                raise
+
+            store(k, value)
+            stats.record_load(time.perf_counter() - start)
+            if shared and shared_cache is not None and current(k):
+                await shared_cache.set(shared, shared_key, value)
+            return value
+
+        def done(k: Any, task: asyncio.Task[T]) -> None:
+            # Unless it was evicted, and another load has started since
+            if in_flight.get(k) is task:
+                del in_flight[k]
+            if not task.cancelled():
+                # Mark the exception as retrieved if there were no waiters left
+                task.exception()
+
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> T:
+            k = key(*args, **kwargs)
+            try:
+                value = cache[k]
+            except KeyError:
+                pass
+            else:
+                stats.hits += 1
+                return value
+
+            task = in_flight.get(k)
+            if task is None or isinstance(task, Reservation):
+                task = asyncio.ensure_future(load(k, args, kwargs))
+                in_flight[k] = task
+                task.add_done_callback(functools.partial(done, k))
+            else:
+                stats.coalesced += 1
+
+            return await asyncio.shield(task)
+
+        wrapper.cache = cache  # type: ignore
+        wrapper.cache_stats = stats  # type: ignore
+        return wrapper
+
+    return decorator
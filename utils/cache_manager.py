@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import sys
+from typing import Any, Optional
+
+from pydantic import BaseModel
+
+from utils.cache import InstrumentedTTLCache
+
+# Used for a cache's entries until it has some to measure
+DEFAULT_ENTRY_SIZE = 1024
+
+
+def estimate_size(obj: Any, seen: Optional[set[int]] = None) -> int:
+    """
+    Approximate the memory used by an object and everything it references, counting
+    shared objects once. Enough to compare caches, not exact.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, int, float, bool)) or obj is None:
+        return size
+
+    if isinstance(obj, dict):
+        return size + sum(
+            estimate_size(k, seen) + estimate_size(v, seen) for k, v in obj.items()
+        )
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return size + sum(estimate_size(v, seen) for v in obj)
+
+    if isinstance(obj, BaseModel):
+        # Prisma models keep their fields in __dict__, and pydantic's state besides
+        size += estimate_size(obj.__dict__, seen)
+        return size + sum(
+            estimate_size(getattr(obj, name, None), seen)
+            for name in ("__pydantic_fields_set__", "__pydantic_extra__")
+        )
+
+    # Other objects, such as the DatabaseUtils in every key, aren't owned by the cache
+    for cls in type(obj).__mro__:
+        for name in getattr(cls, "__slots__", ()):
+            size += estimate_size(getattr(obj, name, None), seen)
+    return size
+
+
+class ManagedCache:
+    """A cache's counts at the last rebalance, to find its hits since"""
+
+    __slots__ = ("cache", "fixed", "entry_size", "hits", "ghost_hits")
+
+    def __init__(self, cache: InstrumentedTTLCache, fixed: bool) -> None:
+        self.cache = cache
+        # Sized by an override rather than the budget
+        self.fixed = fixed
+        self.entry_size = DEFAULT_ENTRY_SIZE
+        self.hits = cache.hits
+        self.ghost_hits = cache.ghost_hits
+
+
+class CacheManager:
+    """
+    Sizes caches to fit a memory budget.
+
+    Periodically, each cache's entry size is estimated from a sample of its entries,
+    and caches are resized by how useful more entries would be. A cache grows when
+    misses on recently evicted keys (ghost hits) show it is too small. If the caches
+    could use more than the budget when full, room they aren't using is taken back
+    first, then those with the fewest hits per byte are shrunk.
+    """
+
+    def __init__(
+        self,
+        budget: Optional[int],
+        overrides: Optional[dict[str, int]] = None,
+        min_size: int = 256,
+        sample_size: int = 32,
+    ) -> None:
+        # In bytes. Without a budget, only the overrides are applied
+        self.budget = budget
+        # Fixed maximum sizes, by cache name
+        self.overrides = overrides or {}
+        self.min_size = min_size
+        self.sample_size = sample_size
+        self.caches: dict[str, ManagedCache] = {}
+
+    def register(self, name: str, cache: InstrumentedTTLCache) -> None:
+        override = self.overrides.get(name)
+        if override is not None:
+            cache.resize(override)
+        self.caches[name] = ManagedCache(cache, override is not None)
+
+    def measure(self, managed: ManagedCache) -> None:
+        sample = managed.cache.sample(self.sample_size)
+        if sample:
+            total = sum(estimate_size(item) for item in sample)
+            managed.entry_size = max(total // len(sample), 1)
+
+    @property
+    def used(self) -> int:
+        """The estimated bytes used by every cache"""
+        return sum(m.cache.currsize * m.entry_size for m in self.caches.values())
+
+    @property
+    def allocated(self) -> int:
+        """The estimated bytes every cache would use if full"""
+        return sum(int(m.cache.maxsize) * m.entry_size for m in self.caches.values())
+
+    def rebalance(self) -> dict[str, int]:
+        """Resize the caches, and return their new maximum sizes"""
+        wanted: dict[str, int] = {}
+        value: dict[str, float] = {}
+        for name, managed in self.caches.items():
+            cache = managed.cache
+            self.measure(managed)
+
+            hits = cache.hits - managed.hits
+            ghost_hits = cache.ghost_hits - managed.ghost_hits
+            managed.hits, managed.ghost_hits = cache.hits, cache.ghost_hits
+            if managed.fixed or self.budget is None:
+                continue
+
+            maxsize = int(cache.maxsize)
+            wanted[name] = maxsize
+            if ghost_hits:
+                # Grow by how many of the recently evicted keys were wanted again
+                growth = maxsize * ghost_hits / cache.ghost_capacity
+                wanted[name] += max(int(growth), maxsize // 4)
+
+            # Hits per byte, with ghost hits being the hits a larger cache would add
+            value[name] = (hits + ghost_hits) / max(
+                cache.currsize * managed.entry_size, 1
+            )
+
+        if wanted and self.budget is not None:
+            excess = sum(
+                int(m.cache.maxsize) * m.entry_size
+                for name, m in self.caches.items()
+                if name not in wanted
+            )
+            excess += sum(
+                size * self.caches[name].entry_size for name, size in wanted.items()
+            )
+            excess -= self.budget
+
+            # Room a cache isn't using is taken back first, then the least useful entries
+            slack = {
+                name: max(int(self.caches[name].cache.currsize * 1.5), self.min_size)
+                for name in wanted
+            }
+            excess = self.trim(wanted, excess, slack, list(wanted))
+            excess = self.trim(
+                wanted,
+                excess,
+                dict.fromkeys(wanted, self.min_size),
+                sorted(wanted, key=lambda n: value[n]),
+            )
+
+        for name, size in wanted.items():
+            if size != self.caches[name].cache.maxsize:
+                self.caches[name].cache.resize(size)
+
+        return {name: int(m.cache.maxsize) for name, m in self.caches.items()}
+
+    def trim(
+        self,
+        wanted: dict[str, int],
+        excess: int,
+        floors: dict[str, int],
+        order: list[str],
+    ) -> int:
+        """Shrink caches in order, no smaller than their floors, until `excess` bytes are freed"""
+        for name in order:
+            if excess <= 0:
+                break
+            entry_size = self.caches[name].entry_size
+            freed = min(wanted[name] - floors[name], math.ceil(excess / entry_size))
+            if freed > 0:
+                wanted[name] -= freed
+                excess -= freed * entry_size
+        return excess
+
+    async def run(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            self.rebalance()
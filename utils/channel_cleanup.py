@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import asyncio
+from typing import TYPE_CHECKING, Optional
+
+from cachetools import TTLCache
+
+import config
+from utils.types import DiscordID, LogLevel
+
+if TYPE_CHECKING:
+    from utils.client import VCRolesClient
+
+
+class ChannelCleanup:
+    """
+    Removes the rows of deleted channels in batches, so deleting many channels at once,
+    such as a category, doesn't run a query per channel for each table.
+    """
+
+    def __init__(self, client: VCRolesClient) -> None:
+        self.client = client
+        # Seconds between flushes, and the number of channels which flush early
+        self.interval: float = getattr(config, "CHANNEL_CLEANUP_INTERVAL", 5.0)
+        self.batch_size: int = getattr(config, "CHANNEL_CLEANUP_BATCH_SIZE", 500)
+        # Channel ID -> guild ID
+        self.pending: dict[int, int] = {}
+        # Those of ignored channels, which only have their links deleted
+        self.pending_links: dict[int, int] = {}
+        # Channels the bot is deleting itself, whose generator rows are already removed
+        self.ignored: TTLCache[int, bool] = TTLCache(2**12, 60)
+        self.full = asyncio.Event()
+        self.task: Optional[asyncio.Task[None]] = None
+        self.deleted = 0
+        self.skipped = 0
+
+    def ignore(self, *channel_ids: DiscordID) -> None:
+        """
+        Only clean up the links of channels about to be deleted by the bot, which removes
+        their generator and generated channel rows itself
+        """
+        for channel_id in channel_ids:
+            self.ignored[int(channel_id)] = True
+
+    def add(self, guild_id: int, channel_id: int) -> None:
+        if self.ignored.pop(channel_id, None):
+            self.skipped += 1
+            self.pending_links[channel_id] = guild_id
+        else:
+            self.pending[channel_id] = guild_id
+        if len(self.pending) + len(self.pending_links) >= self.batch_size:
+            self.full.set()
+
+    async def flush(self) -> None:
+        if not self.pending and not self.pending_links:
+            return
+
+        pending, self.pending = self.pending, {}
+        pending_links, self.pending_links = self.pending_links, {}
+        try:
+            self.deleted += await self.client.db.delete_channels(
+                [(guild_id, channel_id) for channel_id, guild_id in pending.items()],
+                [
+                    (guild_id, channel_id)
+                    for channel_id, guild_id in pending_links.items()
+                ],
+            )
+        except asyncio.CancelledError:
+            self.requeue(pending, pending_links)
+            raise
+        except Exception as e:
+            self.requeue(pending, pending_links)
+            self.client.log(LogLevel.ERROR, f"Failed to clean up channels: {e}")
+
+    def requeue(self, pending: dict[int, int], pending_links: dict[int, int]) -> None:
+        """Keep channels to try again at the next flush"""
+        for channel_id, guild_id in pending.items():
+            self.pending.setdefault(channel_id, guild_id)
+        for channel_id, guild_id in pending_links.items():
+            self.pending_links.setdefault(channel_id, guild_id)
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.full.clear()
+            await self.flush()
+
+    def start(self) -> None:
+        self.task = self.client.loop.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            # A flush it was running requeues its channels, for the final flush below
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.flush()
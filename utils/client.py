@@ -1,21 +1,27 @@
 from __future__ import annotations
 
+import asyncio
 import datetime
-from typing import Any
+from typing import Any, Optional
 
 import aiohttp
 import discord
 import redis.asyncio as aioredis
-from cachetools import TTLCache
 from discord.ext import commands
+from redis.exceptions import RedisError
 
+import config
+from utils.cache import InstrumentedTTLCache
+from utils.cache_manager import CacheManager
+from utils.channel_cleanup import ChannelCleanup
 from utils.database import DatabaseUtils
 from utils.types import LogLevel
+from utils.warm_up import CacheWarmUp
 from views.interface import Interface
 
 
 class VCRolesClient(commands.AutoShardedBot):
-    entitlements_cache: TTLCache[Any, Any] = TTLCache(2**8, 60 * 60)
+    entitlements_cache = InstrumentedTTLCache(2**8, 60 * 60)
 
     def __init__(
         self,
@@ -27,6 +33,26 @@ class VCRolesClient(commands.AutoShardedBot):
         self.ar = ar
         self.db = db
         self.log_queue: list[str] = []
+        # Counter increments not yet written to Redis
+        self.counter_deltas: dict[str, int] = {}
+        self.counter_flush_interval: float = getattr(
+            config, "COUNTER_FLUSH_INTERVAL", 10.0
+        )
+        self.counter_flush_task: Optional[asyncio.Task[None]] = None
+        self.warm_up = CacheWarmUp(self)
+        self.channel_cleanup = ChannelCleanup(self)
+
+        self.cache_manager = CacheManager(
+            getattr(config, "CACHE_MEMORY_BUDGET", 256 * 2**20),
+            getattr(config, "CACHE_SIZES", {}),
+        )
+        for name in db.invalidatable_caches:
+            self.cache_manager.register(name, getattr(db, name))
+        self.cache_manager.register("entitlements_cache", self.entitlements_cache)
+        self.cache_resize_interval: float = getattr(
+            config, "CACHE_RESIZE_INTERVAL", 60 * 5
+        )
+        self.cache_resize_task: Optional[asyncio.Task[None]] = None
         self.console_log_level = console_log_level
         super().__init__(
             intents=intents,
@@ -39,16 +65,39 @@ class VCRolesClient(commands.AutoShardedBot):
         )
         self.persistent_views_added = False
 
-    def incr_counter(self, cmd_name: str):
-        """Increments the counter for a command"""
-        self.loop.create_task(self.ar.hincrby("counters", cmd_name, 1))
+    def incr_counter(self, cmd_name: str, count: int = 1):
+        """Increments the counter for a command. Counters are written to Redis periodically."""
+        if count:
+            self.counter_deltas[cmd_name] = self.counter_deltas.get(cmd_name, 0) + count
 
     def incr_role_counter(self, action: str, count: int = 1):
         """
         action: `add` or `remove`.
         Increments the counter for roles added or removed
         """
-        self.loop.create_task(self.ar.hincrby("counters", f"roles_{action}", count))
+        self.incr_counter(f"roles_{action}", count)
+
+    async def flush_counters(self) -> None:
+        """Write the accumulated counter increments to Redis in a single pipeline"""
+        if not self.counter_deltas:
+            return
+
+        deltas, self.counter_deltas = self.counter_deltas, {}
+        try:
+            async with self.ar.pipeline(transaction=False) as pipe:
+                for name, count in deltas.items():
+                    pipe.hincrby("counters", name, count)
+                await pipe.execute()
+        except RedisError as e:
+            # Keep them to try again at the next flush
+            for name, count in deltas.items():
+                self.incr_counter(name, count)
+            self.log(LogLevel.ERROR, f"Failed to flush counters: {e}")
+
+    async def flush_counters_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.counter_flush_interval)
+            await self.flush_counters()
 
     async def on_ready(self):
         """
@@ -69,6 +118,9 @@ class VCRolesClient(commands.AutoShardedBot):
 
         print("------")
 
+    async def on_shard_ready(self, shard_id: int):
+        self.warm_up.start(shard_id)
+
     async def on_guild_join(self, guild: discord.Guild):
         self.incr_counter("guilds_join")
 
@@ -83,21 +135,33 @@ class VCRolesClient(commands.AutoShardedBot):
         """
         When a channel is deleted, remove it from the database.
         """
-        await self.db.db.link.delete_many(
-            where={"id": str(channel.id), "guildId": str(channel.guild.id)}
-        )
-        await self.db.db.voicegenerator.delete_many(
-            where={"generatorId": str(channel.id), "guildId": str(channel.guild.id)}
-        )
+        self.channel_cleanup.add(channel.guild.id, channel.id)
 
     async def close(self) -> None:
+        self.warm_up.stop()
+        if self.cache_resize_task:
+            self.cache_resize_task.cancel()
+        await self.channel_cleanup.stop()
         await self.db.disconnect()
 
-        return await super().close()
+        await super().close()
+
+        # Anything counted while the cogs were unloading is flushed too
+        if self.counter_flush_task:
+            self.counter_flush_task.cancel()
+        await self.flush_counters()
 
     async def setup_hook(self) -> None:
         await self.db.connect()
 
+        self.counter_flush_task = self.loop.create_task(
+            self.flush_counters_periodically()
+        )
+        self.cache_resize_task = self.loop.create_task(
+            self.cache_manager.run(self.cache_resize_interval)
+        )
+        self.channel_cleanup.start()
+
         return await super().setup_hook()
 
     def log(self, level: LogLevel, message: str) -> None:
@@ -141,8 +205,10 @@ class VCRolesClient(commands.AutoShardedBot):
 
             self.incr_counter(command_name)
 
-        seen_welcome = await self.ar.hget("seen_welcome", str(interaction.guild.id))
-        webhook = await self.ar.hget("webhooks", str(interaction.guild.id))
+        seen_welcome = await self.db.get_hash_field(
+            "seen_welcome", interaction.guild.id
+        )
+        webhook = await self.db.get_hash_field("webhooks", interaction.guild.id)
         if (
             seen_welcome is None
             and webhook is None
@@ -165,10 +231,10 @@ class VCRolesClient(commands.AutoShardedBot):
                 url=self.user.avatar.url if self.user and self.user.avatar else None
             )
             await interaction.followup.send(embed=embed)
-            await self.ar.hset("seen_welcome", str(interaction.guild.id), "1")
+            await self.db.set_hash_field("seen_welcome", interaction.guild.id, "1")
 
     async def send_welcome(self, guild_id: int):
-        webhook_url = await self.ar.hget("webhooks", str(guild_id))
+        webhook_url = await self.db.get_hash_field("webhooks", guild_id)
         if webhook_url is None:
             return None
 
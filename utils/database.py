@@ -1,60 +1,482 @@
-from typing import Any, List, Optional
-
-from asyncache import cached  # type: ignore
+from __future__ import annotations
+
+import asyncio
+import functools
+import itertools
+import json
+import logging
+import os
+import time
+import uuid
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Iterable, List, Optional, TypeVar
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import redis.asyncio as aioredis
 from cachetools import TTLCache
 from cachetools.keys import hashkey
-from prisma import Prisma
+from prisma import Prisma, load_env
 from prisma.enums import LinkType, VoiceGeneratorOption, VoiceGeneratorType
 from prisma.models import GeneratedChannel, Guild, Link, VoiceGenerator
 from prisma.types import (
     GeneratedChannelUpdateInput,
+    GuildInclude,
     GuildUpdateInput,
+    HttpConfig,
     LinkUpdateInput,
+    LinkWhereInput,
     VoiceGeneratorUpdateInput,
 )
+from redis.exceptions import RedisError
 
+import config
+from utils.cache import InstrumentedTTLCache, Reservation, cached, evict
+from utils.link_index import GuildLinkIndex
+from utils.shared_cache import SharedCache
 from utils.types import DiscordID
 
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Prisma's connection pool options, which are parameters of the database URL, by config name
+POOL_OPTIONS = {
+    "DATABASE_CONNECTION_LIMIT": "connection_limit",
+    "DATABASE_POOL_TIMEOUT": "pool_timeout",
+    "DATABASE_STATEMENT_CACHE_SIZE": "statement_cache_size",
+    "DATABASE_SOCKET_TIMEOUT": "socket_timeout",
+}
+
+# The timed method running in this context, which nested calls are counted towards
+current_method: ContextVar[Optional[str]] = ContextVar("current_method", default=None)
+
+
+def create_client(url: Optional[str] = None) -> Prisma:
+    """
+    A Prisma client for a database URL, DATABASE_URL by default, with the connection
+    pool and query timeout from the config
+    """
+    # Prisma would load it when created, but the URL is needed first
+    load_env()
+    url = url or os.environ.get("DATABASE_URL")
+
+    params = {
+        param: str(getattr(config, name))
+        for name, param in POOL_OPTIONS.items()
+        if getattr(config, name, None) is not None
+    }
+    if url and params:
+        parts = urlsplit(url)
+        query = dict(parse_qsl(parts.query))
+        query.update(params)
+        url = urlunsplit(parts._replace(query=urlencode(query)))
+
+    http: HttpConfig = {}
+    # Seconds to wait for the query engine's response, Prisma's default being 30
+    query_timeout: Optional[float] = getattr(config, "DATABASE_QUERY_TIMEOUT", None)
+    if query_timeout is not None:
+        http["timeout"] = query_timeout
+
+    return Prisma(datasource={"url": url} if url else None, http=http or None)
+
+
+class MethodStats:
+    """Timings of a DatabaseUtils method's calls, and how many are running at once"""
+
+    __slots__ = (
+        "calls",
+        "errors",
+        "total_time",
+        "max_time",
+        "in_flight",
+        "max_in_flight",
+    )
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def start(self) -> None:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def finish(self, elapsed: float) -> None:
+        self.in_flight -= 1
+        self.calls += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+    @property
+    def avg_time(self) -> float:
+        return self.total_time / max(self.calls, 1)
+
+
+def timed(
+    func: Callable[..., Awaitable[T]],
+) -> Callable[..., Awaitable[T]]:
+    """
+    Record the time taken by a method's calls and how many are in flight. Calls made
+    while another timed method is running, such as a cached load it starts, are counted
+    towards that one. Under `cached`, only the misses are timed.
+    """
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(self: DatabaseUtils, *args: Any, **kwargs: Any) -> T:
+        if current_method.get() is not None:
+            return await func(self, *args, **kwargs)
+
+        stats = self.method_stats.get(name)
+        if stats is None:
+            stats = self.method_stats[name] = MethodStats()
+
+        token = current_method.set(name)
+        stats.start()
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        start = time.perf_counter()
+        try:
+            return await func(self, *args, **kwargs)
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            current_method.reset(token)
+            stats.finish(elapsed)
+            self.in_flight -= 1
+            if elapsed >= self.slow_call_time:
+                log.warning(
+                    f"Slow database call: {name} took {elapsed:.2f}s,"
+                    f" {self.in_flight} other calls in flight"
+                )
+
+    return wrapper
+
+
+def key_variants(args: tuple[Any, ...]) -> list[tuple[Any, ...]]:
+    """
+    Every form of a cache key. IDs are passed as both ints and strings, and they
+    hash differently.
+    """
+    options: list[tuple[Any, ...]] = []
+    for arg in args:
+        if isinstance(arg, int) and not isinstance(arg, bool):
+            options.append((arg, str(arg)))
+        elif isinstance(arg, str) and arg.isdigit():
+            options.append((arg, int(arg)))
+        else:
+            options.append((arg,))
+    return list(itertools.product(*options))
 
-class DatabaseUtils:
-    """Tools for interacting with the database"""
 
-    guild_cache: TTLCache[Any, Any] = TTLCache(2**11, 60 * 60)
-    linked_channel_cache: TTLCache[Any, Any] = TTLCache(2**15, 60 * 60)
-    all_links_cache: TTLCache[Any, Any] = TTLCache(2**8, 60 * 60)
-    get_generators_cache: TTLCache[Any, Any] = TTLCache(2**8, 60 * 60)
-    generator_cache: TTLCache[Any, Any] = TTLCache(2**8, 60 * 60)
-    generated_channel_cache: TTLCache[Any, Any] = TTLCache(2**8, 60 * 60)
+class InvalidationStats:
+    """Counts of the invalidations received from other processes, and how late they were"""
+
+    __slots__ = ("published", "received", "total_lag", "last_lag", "max_lag", "resets")
 
     def __init__(self) -> None:
-        self.db = Prisma()
+        self.published = 0
+        self.received = 0
+        self.total_lag = 0.0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        # How many times every cache was cleared after losing the connection
+        self.resets = 0
+
+    def record(self, lag: float) -> None:
+        self.received += 1
+        self.total_lag += lag
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+
+    @property
+    def avg_lag(self) -> float:
+        return self.total_lag / max(self.received, 1)
+
+
+class DatabaseUtils:
+    """Tools for interacting with the database"""
+
+    invalidation_channel = "cache_invalidations"
+
+    guild_cache = InstrumentedTTLCache(2**11, 60 * 60)
+    linked_channel_cache = InstrumentedTTLCache(2**15, 60 * 60)
+    # Includes the channels without a link, as None
+    find_linked_channel_cache = InstrumentedTTLCache(2**15, 60 * 60)
+    all_links_cache = InstrumentedTTLCache(2**8, 60 * 60)
+    link_index_cache = InstrumentedTTLCache(2**13, 60 * 60)
+    get_generators_cache = InstrumentedTTLCache(2**13, 60 * 60)
+    # These are looked up for every voice channel joined, and cache None for most
+    generator_cache = InstrumentedTTLCache(2**15, 60 * 60)
+    generated_channel_cache = InstrumentedTTLCache(2**15, 60 * 60)
+    # Fields of Redis hashes read after every command, which are mostly missing
+    hash_field_cache = InstrumentedTTLCache(2**14, 60 * 60)
+    invalidatable_caches = (
+        "guild_cache",
+        "linked_channel_cache",
+        "find_linked_channel_cache",
+        "all_links_cache",
+        "link_index_cache",
+        "get_generators_cache",
+        "generator_cache",
+        "generated_channel_cache",
+        "hash_field_cache",
+    )
+
+    def __init__(self, ar: Optional[aioredis.Redis[Any]] = None) -> None:
+        self.db = create_client()
+        # Cacheable reads go to the replica, if there is one
+        replica_url: Optional[str] = getattr(config, "DATABASE_REPLICA_URL", None)
+        self.replica: Optional[Prisma] = (
+            create_client(replica_url) if replica_url else None
+        )
+        # IDs written to recently, by this process or another, whose reads stay on the
+        # primary until the replica has caught up
+        self.recent_writes: TTLCache[str, bool] = TTLCache(
+            2**14, getattr(config, "DATABASE_REPLICA_LAG", 10)
+        )
+        self.ar = ar
         self.analytic_guilds: list[Guild] = []
+        # Identifies this process's own invalidations, which are already applied
+        self.process_id = uuid.uuid4().hex
+        self.invalidation_stats = InvalidationStats()
+        self.invalidation_task: Optional[asyncio.Task[None]] = None
+        # Load links with a single SQL query, rather than through Prisma's nested include
+        self.raw_link_queries: bool = getattr(config, "RAW_LINK_QUERIES", False)
+        # Rows found, deleted and invalidated at once by bulk cleanups
+        self.cleanup_batch_size: int = getattr(
+            config, "DATABASE_CLEANUP_BATCH_SIZE", 1000
+        )
+        # Stats of the timed methods, by name, and the calls running across all of them
+        self.method_stats: dict[str, MethodStats] = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        # Calls which take longer are logged, in seconds
+        self.slow_call_time: float = getattr(config, "DATABASE_SLOW_CALL_TIME", 1.0)
+
+        self.shared_cache: Optional[SharedCache] = None
+        if ar is not None and getattr(config, "SHARED_CACHE_ENABLED", True):
+            self.shared_cache = SharedCache(
+                ar,
+                getattr(config, "SHARED_CACHE_TTL", 60 * 60),
+                getattr(config, "SHARED_CACHE_TTLS", {}),
+            )
 
     async def connect(self) -> None:
         await self.db.connect()
+        if self.replica is not None:
+            await self.replica.connect()
+
+        if self.ar is not None:
+            self.invalidation_task = asyncio.create_task(
+                self.listen_for_invalidations()
+            )
 
     async def disconnect(self) -> None:
+        if self.invalidation_task:
+            self.invalidation_task.cancel()
+
         await self.db.disconnect()
+        if self.replica is not None:
+            await self.replica.disconnect()
+
+    def reader(self, *ids: Optional[DiscordID]) -> Prisma:
+        """The client to read rows of these IDs with: the replica, unless they were just written"""
+        if self.replica is None or any(
+            str(i) in self.recent_writes for i in ids if i is not None
+        ):
+            return self.db
+        return self.replica
+
+    async def find_or_create_guild(
+        self, guild_id: DiscordID, include: Optional[GuildInclude] = None
+    ) -> Guild:
+        """A guild's row, created if it doesn't exist"""
+        client = self.reader(guild_id)
+        guild = await client.guild.find_unique(
+            where={"id": str(guild_id)}, include=include
+        )
+        if not guild and client is not self.db:
+            # It may have been created since the replica last caught up
+            guild = await self.db.guild.find_unique(
+                where={"id": str(guild_id)}, include=include
+            )
+        if not guild:
+            guild = await self.db.guild.create({"id": str(guild_id)}, include=include)
+        return guild
+
+    def evict(self, cache_name: str, *args: Any) -> None:
+        """Remove a key from one of the caches in this process"""
+        if self.replica is not None:
+            for arg in args:
+                if isinstance(arg, (int, str)):
+                    self.recent_writes[str(arg)] = True
+        cache: InstrumentedTTLCache = getattr(self, cache_name)
+        for variant in key_variants(args):
+            evict(cache, hashkey(self, *variant))
+
+    async def invalidate(self, *keys: tuple[Any, ...]) -> None:
+        """
+        Remove keys from the caches in this process and the shared cache, and publish them
+        for every other process to remove. Each key is the cache's name followed by the
+        function's arguments.
+        """
+        for cache_name, *args in keys:
+            self.evict(cache_name, *args)
+
+        if self.shared_cache is not None:
+            # Before publishing, so other processes don't reload the old value from it
+            await self.shared_cache.delete(keys)
+
+        if self.ar is None:
+            return
+
+        message = json.dumps(
+            {"o": self.process_id, "t": time.time(), "k": keys}, default=str
+        )
+        try:
+            await self.ar.publish(self.invalidation_channel, message)
+            self.invalidation_stats.published += 1
+        except RedisError as e:
+            log.error(f"Failed to publish cache invalidation: {e}")
+
+    def handle_invalidation(self, data: str) -> None:
+        message = json.loads(data)
+        if message["o"] == self.process_id:
+            return
+
+        for cache_name, *args in message["k"]:
+            self.evict(cache_name, *args)
+        self.invalidation_stats.record(max(0.0, time.time() - message["t"]))
+
+    def clear_caches(self) -> None:
+        for cache_name in self.invalidatable_caches:
+            getattr(self, cache_name).clear()
+
+    def cache_report(self) -> dict[str, dict[str, Any]]:
+        """The size and stats of each cache, and the loads made by the function it caches"""
+        functions = {
+            id(f.cache): f.cache_stats
+            for f in vars(DatabaseUtils).values()
+            if hasattr(f, "cache_stats")
+        }
+
+        report: dict[str, dict[str, Any]] = {}
+        for cache_name in self.invalidatable_caches:
+            cache: InstrumentedTTLCache = getattr(self, cache_name)
+            stats = functions[id(cache)]
+            report[cache_name] = {
+                "size": cache.currsize,
+                "maxsize": cache.maxsize,
+                "hits": stats.hits,
+                "misses": stats.misses,
+                "hit_ratio": stats.l1_ratio,
+                "l2_hits": stats.l2_hits,
+                "l2_hit_ratio": stats.l2_ratio,
+                "evictions": cache.evictions,
+                "expirations": cache.expirations,
+                "load_ms_avg": stats.avg_load_time * 1000,
+                "load_ms_max": stats.max_load_time * 1000,
+            }
+        return report
 
+    def method_report(self) -> dict[str, dict[str, Any]]:
+        """The timings and concurrency of each timed method, slowest in total first"""
+        stats = sorted(
+            self.method_stats.items(), key=lambda x: x[1].total_time, reverse=True
+        )
+        return {
+            name: {
+                "calls": s.calls,
+                "errors": s.errors,
+                "ms_avg": s.avg_time * 1000,
+                "ms_max": s.max_time * 1000,
+                "ms_total": s.total_time * 1000,
+                "in_flight": s.in_flight,
+                "max_in_flight": s.max_in_flight,
+            }
+            for name, s in stats
+        }
+
+    async def pool_report(self) -> dict[str, float]:
+        """
+        The connection pool's gauges from Prisma's metrics, such as the busy connections
+        and the queries waiting for one
+        """
+        try:
+            metrics = await self.db.get_metrics()
+        except Exception as e:
+            log.error(f"Failed to get the database metrics: {e}")
+            return {}
+
+        return {
+            m.key: m.value
+            for m in metrics.gauges
+            if m.key.startswith(("prisma_pool_", "prisma_client_queries_"))
+        }
+
+    async def listen_for_invalidations(self) -> None:
+        """Apply the invalidations published by other processes"""
+        assert self.ar is not None
+        connected_before = False
+        while True:
+            try:
+                async with self.ar.pubsub() as pubsub:
+                    await pubsub.subscribe(self.invalidation_channel)
+                    if connected_before:
+                        # Invalidations may have been missed while disconnected
+                        self.clear_caches()
+                        self.invalidation_stats.resets += 1
+                    connected_before = True
+
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        try:
+                            self.handle_invalidation(message["data"])
+                        except (ValueError, KeyError, TypeError) as e:
+                            log.error(f"Invalid cache invalidation: {e}")
+            except (RedisError, OSError) as e:
+                log.error(f"Cache invalidation listener disconnected: {e}")
+                await asyncio.sleep(5)
+
+    @cached(hash_field_cache)
+    async def get_hash_field(self, name: str, field: DiscordID) -> Optional[str]:
+        """A field of a Redis hash, such as a guild's update channel webhook"""
+        assert self.ar is not None
+        return await self.ar.hget(name, str(field))
+
+    async def set_hash_field(self, name: str, field: DiscordID, value: str) -> None:
+        """Set a field of a Redis hash read through `get_hash_field`"""
+        assert self.ar is not None
+        await self.ar.hset(name, str(field), value)
+        await self.invalidate(("hash_field_cache", name, field))
+
+    @timed
     async def guild_remove(self, guild_id: DiscordID) -> None:
         await self.db.guild.delete(where={"id": str(guild_id)})
 
-        try:
-            k = hashkey(self, guild_id)
-            del self.guild_cache[k]
-        except KeyError:
-            pass
+        await self.invalidate(
+            ("guild_cache", guild_id),
+            ("all_links_cache", guild_id),
+            ("link_index_cache", guild_id),
+        )
 
+    @timed
     async def guild_add(self, guild_id: DiscordID) -> None:
         await self.db.guild.create({"id": str(guild_id)})
 
-    @cached(guild_cache)
+    @cached(guild_cache, shared="guild_cache")
+    @timed
     async def get_guild_data(self, guild_id: DiscordID) -> Guild:
-        data = await self.db.guild.find_unique(where={"id": str(guild_id)})
-        if not data:
-            data = await self.db.guild.create({"id": str(guild_id)})
-        return data
+        return await self.find_or_create_guild(guild_id)
 
+    @timed
     async def update_guild_data(
         self,
         guild_id: DiscordID,
@@ -106,20 +528,13 @@ class DatabaseUtils:
                 }
             )
 
-        try:
-            k = hashkey(self, guild_id)
-            del self.guild_cache[k]
-        except KeyError:
-            pass
+        await self.invalidate(("guild_cache", guild_id))
 
-    def remove_guild_from_cache(self, guild_id: DiscordID) -> None:
-        try:
-            k = hashkey(self, guild_id)
-            del self.guild_cache[k]
-        except KeyError:
-            pass
+    async def remove_guild_from_cache(self, guild_id: DiscordID) -> None:
+        await self.invalidate(("guild_cache", guild_id))
 
-    @cached(linked_channel_cache)
+    @cached(linked_channel_cache, shared="linked_channel_cache")
+    @timed
     async def get_channel_linked(
         self,
         channel_id: DiscordID,
@@ -136,6 +551,20 @@ class DatabaseUtils:
             )
         return data
 
+    @cached(find_linked_channel_cache, shared="find_linked_channel_cache")
+    @timed
+    async def find_channel_linked(
+        self,
+        channel_id: DiscordID,
+        guild_id: DiscordID,
+        link_type: LinkType = LinkType.REGULAR,
+    ) -> Optional[Link]:
+        """Like `get_channel_linked`, but returns None instead of creating the link"""
+        return await self.reader(channel_id, guild_id).link.find_unique(
+            where={"id_type": {"id": str(channel_id), "type": link_type}}
+        )
+
+    @timed
     async def update_channel_linked(  # TODO: Make cache work
         self,
         channel_id: DiscordID,
@@ -185,44 +614,72 @@ class DatabaseUtils:
                 }
             )
 
-        try:
-            k = hashkey(self, channel_id, guild_id, link_type)
-            del self.linked_channel_cache[k]
-        except KeyError:
-            pass
+        await self.invalidate(
+            *self.linked_channel_keys(channel_id, guild_id, link_type),
+            ("all_links_cache", guild_id),
+            ("link_index_cache", guild_id),
+        )
 
-        try:
-            k = hashkey(self, guild_id)
-            del self.all_links_cache[k]
-        except KeyError:
-            pass
+    @staticmethod
+    def linked_channel_keys(
+        channel_id: DiscordID,
+        guild_id: DiscordID,
+        link_type: Optional[LinkType] = None,
+    ) -> list[tuple[Any, ...]]:
+        """
+        The keys of a channel's links in the link caches, for one or all link types.
+        The key doesn't include the link type when it was left as the default.
+        """
+        link_types = [link_type] if link_type else list(LinkType)
+        keys: list[tuple[Any, ...]] = []
+        for cache_name in ("linked_channel_cache", "find_linked_channel_cache"):
+            keys += [(cache_name, channel_id, guild_id, t) for t in link_types]
+            if LinkType.REGULAR in link_types:
+                keys.append((cache_name, channel_id, guild_id))
+        return keys
+
+    async def remove_links_from_cache(self, guild_id: DiscordID) -> None:
+        await self.invalidate(
+            ("all_links_cache", guild_id),
+            ("link_index_cache", guild_id),
+        )
 
-    @cached(all_links_cache)
+    @cached(all_links_cache, shared="all_links_cache")
+    @timed
     async def get_all_linked(self, guild_id: DiscordID) -> List[Link]:
-        guild = await self.db.guild.find_unique(
-            where={"id": str(guild_id)}, include={"links": True}
-        )
-        if not guild:
-            guild = await self.db.guild.create(
-                {"id": str(guild_id)}, include={"links": True}
-            )
+        return await self.load_links(guild_id)
 
+    @timed
+    async def load_links(self, guild_id: DiscordID) -> List[Link]:
+        if self.raw_link_queries:
+            # Links can be read without the guild's row, so it isn't created here
+            return await self.query_links(guild_id)
+
+        guild = await self.find_or_create_guild(guild_id, include={"links": True})
         return guild.links or []
 
-    @cached(get_generators_cache)
+    @cached(link_index_cache, shared="link_index_cache")
+    @timed
+    async def get_link_index(self, guild_id: DiscordID) -> GuildLinkIndex:
+        # Not through get_all_linked, so the Prisma models aren't kept in its cache
+        return GuildLinkIndex(guild_id, await self.load_links(guild_id))
+
+    @cached(get_generators_cache, shared="get_generators_cache")
+    @timed
     async def get_generators(self, guild_id: DiscordID) -> list[VoiceGenerator]:
-        data = await self.db.voicegenerator.find_many(
+        data = await self.reader(guild_id).voicegenerator.find_many(
             where={"guildId": str(guild_id)}, include={"openChannels": True}
         )
         if not data:
             return []
         return data
 
-    @cached(generator_cache)
+    @cached(generator_cache, shared="generator_cache")
+    @timed
     async def get_generator(
         self, guild_id: DiscordID, generator_id: DiscordID
     ) -> Optional[VoiceGenerator]:
-        data = await self.db.voicegenerator.find_unique(
+        data = await self.reader(guild_id, generator_id).voicegenerator.find_unique(
             where={
                 "guildId_generatorId": {
                     "generatorId": str(generator_id),
@@ -233,6 +690,7 @@ class DatabaseUtils:
         )
         return data
 
+    @timed
     async def update_generator(
         self,
         guild_id: DiscordID,
@@ -303,36 +761,28 @@ class DatabaseUtils:
                 }
             )
 
-        try:
-            k = hashkey(self, guild_id)
-            del self.get_generators_cache[k]
-        except KeyError:
-            pass
-
-        try:
-            k = hashkey(self, guild_id, generator_id)
-            del self.generator_cache[k]
-        except KeyError:
-            pass
+        await self.invalidate(
+            ("get_generators_cache", guild_id),
+            ("generator_cache", guild_id, generator_id),
+        )
 
-    @cached(generated_channel_cache)
+    @cached(generated_channel_cache, shared="generated_channel_cache")
+    @timed
     async def get_generated_channel(
         self, channel_id: DiscordID
     ) -> Optional[GeneratedChannel]:
-        data = await self.db.generatedchannel.find_unique(
+        data = await self.reader(channel_id).generatedchannel.find_unique(
             where={"channelId": str(channel_id)}, include={"VoiceGenerator": True}
         )
         return data
 
+    @timed
     async def delete_generated_channel(self, channel_id: DiscordID) -> None:
         await self.db.generatedchannel.delete(where={"channelId": str(channel_id)})
 
-        try:
-            k = hashkey(self, channel_id)
-            del self.generated_channel_cache[k]
-        except KeyError:
-            pass
+        await self.invalidate(("generated_channel_cache", channel_id))
 
+    @timed
     async def update_generated_channel(
         self,
         channel_id: DiscordID,
@@ -358,12 +808,9 @@ class DatabaseUtils:
             where={"channelId": str(channel_id)}, data=data
         )
 
-        try:
-            k = hashkey(self, channel_id)
-            del self.generated_channel_cache[k]
-        except KeyError:
-            pass
+        await self.invalidate(("generated_channel_cache", channel_id))
 
+    @timed
     async def create_generated_channel(
         self,
         guild_id: DiscordID,
@@ -390,26 +837,15 @@ class DatabaseUtils:
             }
         )
 
-        try:
-            k = hashkey(self, guild_id)
-            del self.get_generators_cache[k]
-        except KeyError:
-            pass
-
-        try:
-            k = hashkey(self, guild_id, generator_id)
-            del self.generator_cache[k]
-        except KeyError:
-            pass
-
-        try:
-            k = hashkey(self, channel_id)
-            del self.generated_channel_cache[k]
-        except KeyError:
-            pass
+        await self.invalidate(
+            ("get_generators_cache", guild_id),
+            ("generator_cache", guild_id, generator_id),
+            ("generated_channel_cache", channel_id),
+        )
 
         return data
 
+    @timed
     async def delete_generator(
         self, guild_id: DiscordID, generator_id: DiscordID
     ) -> None:
@@ -422,18 +858,259 @@ class DatabaseUtils:
             }
         )
 
-        try:
-            k = hashkey(self, guild_id)
-            del self.get_generators_cache[k]
-        except KeyError:
-            pass
+        await self.invalidate(
+            ("get_generators_cache", guild_id),
+            ("generator_cache", guild_id, generator_id),
+        )
+
+    @timed
+    async def delete_guild_generators(self, guild_id: DiscordID) -> int:
+        """Delete every generator in a guild, returning the number deleted"""
+        generators = await self.db.voicegenerator.find_many(
+            where={"guildId": str(guild_id)}, include={"openChannels": True}
+        )
+        if not generators:
+            return 0
+
+        deleted = await self.db.voicegenerator.delete_many(
+            where={"id": {"in": [g.id for g in generators]}}
+        )
+
+        keys: list[tuple[Any, ...]] = [("get_generators_cache", guild_id)]
+        for generator in generators:
+            keys.append(("generator_cache", guild_id, generator.generatorId))
+            # Deleted with the generator
+            keys += [
+                ("generated_channel_cache", c.channelId)
+                for c in generator.openChannels or []
+            ]
+        await self.invalidate(*keys)
+        return deleted
+
+    @timed
+    async def delete_channels(
+        self,
+        channels: Iterable[tuple[DiscordID, DiscordID]],
+        links_only: Iterable[tuple[DiscordID, DiscordID]] = (),
+    ) -> int:
+        """
+        Delete the links, generators and generated channels of channels which have been
+        deleted, given as (guild ID, channel ID), in one query per table. Only the links
+        of `links_only` are deleted. Returns the number of rows deleted.
+        """
+        guild_of = {str(channel_id): str(guild_id) for guild_id, channel_id in channels}
+        link_guild_of = {
+            **{str(channel_id): str(guild_id) for guild_id, channel_id in links_only},
+            **guild_of,
+        }
+        if not link_guild_of:
+            return 0
+        channel_ids = list(guild_of)
+        guild_ids = list(set(guild_of.values()))
+
+        links = await self.db.link.find_many(
+            where={
+                "id": {"in": list(link_guild_of)},
+                "guildId": {"in": list(set(link_guild_of.values()))},
+            }
+        )
+        generators: list[VoiceGenerator] = []
+        generated: list[GeneratedChannel] = []
+        if guild_of:
+            generators = await self.db.voicegenerator.find_many(
+                where={
+                    "guildId": {"in": guild_ids},
+                    "generatorId": {"in": channel_ids},
+                },
+                include={"openChannels": True},
+            )
+            generated = await self.db.generatedchannel.find_many(
+                where={"channelId": {"in": channel_ids}},
+                include={"VoiceGenerator": True},
+            )
+        # Only rows of the guild the channel was in
+        links = [link for link in links if link_guild_of[link.id] == link.guildId]
+        generators = [g for g in generators if guild_of[g.generatorId] == g.guildId]
+
+        deleted = 0
+        keys: list[tuple[Any, ...]] = []
+        if links:
+            deleted += await self.db.link.delete_many(
+                where={"dbId": {"in": [link.dbId for link in links]}}
+            )
+            for link in links:
+                keys += self.linked_channel_keys(link.id, link.guildId, link.type)
+            for guild_id in {link.guildId for link in links}:
+                keys += [("all_links_cache", guild_id), ("link_index_cache", guild_id)]
+
+        if generated:
+            deleted += await self.db.generatedchannel.delete_many(
+                where={"id": {"in": [c.id for c in generated]}}
+            )
+            for channel in generated:
+                keys.append(("generated_channel_cache", channel.channelId))
+                # Its generator's open channels
+                if channel.VoiceGenerator:
+                    guild_id = channel.VoiceGenerator.guildId
+                    generator_id = channel.VoiceGenerator.generatorId
+                    keys += [
+                        ("get_generators_cache", guild_id),
+                        ("generator_cache", guild_id, generator_id),
+                    ]
+
+        if generators:
+            deleted += await self.db.voicegenerator.delete_many(
+                where={"id": {"in": [g.id for g in generators]}}
+            )
+            for generator in generators:
+                keys += [
+                    ("get_generators_cache", generator.guildId),
+                    ("generator_cache", generator.guildId, generator.generatorId),
+                ]
+                # Deleted with the generator
+                keys += [
+                    ("generated_channel_cache", c.channelId)
+                    for c in generator.openChannels or []
+                ]
+
+        if keys:
+            await self.invalidate(*set(keys))
+        return deleted
+
+    @timed
+    async def delete_empty_links(self) -> int:
+        """Delete the links with no roles, excluded channels or suffix"""
+        where: LinkWhereInput = {
+            "linkedRoles": {"isEmpty": True},
+            "reverseLinkedRoles": {"isEmpty": True},
+            "speakerRoles": {"isEmpty": True},
+            "excludeChannels": {"isEmpty": True},
+            "suffix": None,
+        }
+        deleted = 0
+        last: Optional[str] = None
+        while True:
+            # In batches, to keep each query, delete and invalidation message small
+            empty = await self.db.link.find_many(
+                where={**where, "dbId": {"gt": last}} if last else where,
+                order={"dbId": "asc"},
+                take=self.cleanup_batch_size,
+            )
+            if not empty:
+                return deleted
+            last = empty[-1].dbId
+
+            # Still only if empty, as a role may have been added since they were found
+            deleted += await self.db.link.delete_many(
+                where={**where, "dbId": {"in": [link.dbId for link in empty]}}
+            )
+
+            keys: list[tuple[Any, ...]] = []
+            for link in empty:
+                keys += self.linked_channel_keys(link.id, link.guildId, link.type)
+            for guild_id in {link.guildId for link in empty}:
+                keys += [("all_links_cache", guild_id), ("link_index_cache", guild_id)]
+            await self.invalidate(*keys)
+
+    def is_warm(self, guild_id: DiscordID) -> bool:
+        return hashkey(self, guild_id) in self.link_index_cache
+
+    @timed
+    async def warm_up(
+        self,
+        guild_ids: list[int],
+        channel_ids: Optional[dict[int, list[int]]] = None,
+    ) -> int:
+        """
+        Load the guild rows, links and generators of many guilds at once, and add what
+        voice events use to the caches. Returns the number of guilds found.
+
+        `channel_ids` are the voice channels of each guild, whose generator and generated
+        channel rows are cached, including for those which have none.
+        """
+        # Keys evicted or loaded while the queries run aren't stored, as they may be newer
+        channels = [(g, c) for g, cs in (channel_ids or {}).items() for c in cs]
+        guilds_reserved = Reservation(
+            self.guild_cache, [hashkey(self, g) for g in guild_ids]
+        )
+        indexes_reserved = Reservation(
+            self.link_index_cache, [hashkey(self, g) for g in guild_ids]
+        )
+        generators_reserved = Reservation(
+            self.generator_cache, [hashkey(self, g, c) for g, c in channels]
+        )
+        generated_reserved = Reservation(
+            self.generated_channel_cache, [hashkey(self, c) for _, c in channels]
+        )
+        reservations = (
+            guilds_reserved,
+            indexes_reserved,
+            generators_reserved,
+            generated_reserved,
+        )
 
         try:
-            k = hashkey(self, guild_id, generator_id)
-            del self.generator_cache[k]
-        except KeyError:
-            pass
+            ids = [str(i) for i in guild_ids]
+            client = self.reader(*ids)
+            guilds = await client.guild.find_many(
+                where={"id": {"in": ids}}, include={"links": True}
+            )
+            generators = await client.voicegenerator.find_many(
+                where={"guildId": {"in": ids}}, include={"openChannels": True}
+            )
 
+            for generator in generators:
+                generators_reserved.store(
+                    hashkey(self, int(generator.guildId), int(generator.generatorId)),
+                    generator,
+                )
+                # As get_generated_channel includes it, without its open channels
+                included = generator.model_copy(update={"openChannels": None})
+                for channel in generator.openChannels or []:
+                    generated_reserved.store(
+                        hashkey(self, int(channel.channelId)),
+                        channel.model_copy(update={"VoiceGenerator": included}),
+                    )
+
+            # The rest are neither, unless stored above
+            for guild_id, channel_id in channels:
+                generators_reserved.store(hashkey(self, guild_id, channel_id), None)
+                generated_reserved.store(hashkey(self, channel_id), None)
+
+            for guild in guilds:
+                guild_id = int(guild.id)
+                links = guild.links or []
+                # get_guild_data doesn't include the links
+                guild.links = None
+
+                guilds_reserved.store(hashkey(self, guild_id), guild)
+                indexes_reserved.store(
+                    hashkey(self, guild_id), GuildLinkIndex(guild_id, links)
+                )
+        finally:
+            for reservation in reservations:
+                reservation.release()
+
+        return len(guilds)
+
+    link_query = (
+        'SELECT "dbId", "id", "type", "guildId", "linkedRoles", "reverseLinkedRoles",'
+        ' "suffix", "speakerRoles", "excludeChannels" FROM "Link" WHERE "guildId" = $1'
+    )
+
+    @timed
+    async def query_links(
+        self, guild_id: DiscordID, ids: Optional[list[str]] = None
+    ) -> List[Link]:
+        """A guild's links, or those with the given IDs, in a single parameterised query"""
+        client = self.reader(guild_id, *(ids or ()))
+        if ids is None:
+            return await client.query_raw(self.link_query, str(guild_id), model=Link)
+        return await client.query_raw(
+            self.link_query + ' AND "id" = ANY($2)', str(guild_id), ids, model=Link
+        )
+
+    @timed
     async def get_all_linked_channel(
         self,
         guild_id: DiscordID,
@@ -446,13 +1123,11 @@ class DatabaseUtils:
         else:
             s = [str(channel_id), str(guild_id)]
 
-        guild = await self.db.guild.find_unique(
-            where={"id": str(guild_id)},
-            include={"links": {"where": {"OR": [{"id": i} for i in s]}}},
+        if self.raw_link_queries:
+            return await self.query_links(guild_id, s)
+
+        guild = await self.find_or_create_guild(
+            guild_id, include={"links": {"where": {"OR": [{"id": i} for i in s]}}}
         )
-        if not guild:
-            guild = await self.db.guild.create(
-                {"id": str(guild_id)}, include={"links": True}
-            )
 
         return guild.links or []
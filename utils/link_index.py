@@ -0,0 +1,291 @@
+from __future__ import annotations
+
+from typing import Any, Iterable, NamedTuple, Optional
+
+import discord
+
+from prisma.enums import LinkType
+from prisma.models import Link
+
+from utils.types import DiscordID, SuffixConstructor
+
+
+def role_ids(roles: Iterable[str]) -> tuple[int, ...]:
+    return tuple(dict.fromkeys(int(r) for r in roles if r.isdigit()))
+
+
+# Shared by the links which don't exclude any channels, as each empty set is 200 bytes
+NO_CHANNELS: frozenset[int] = frozenset()
+
+
+def channel_ids(channels: Iterable[int | str]) -> frozenset[int]:
+    ids = frozenset(int(c) for c in channels if str(c).isdigit())
+    return ids or NO_CHANNELS
+
+
+def union(masks: Iterable[int]) -> int:
+    mask = 0
+    for m in masks:
+        mask |= m
+    return mask
+
+
+class RoleBits:
+    """
+    Numbers each role linked in a guild, so sets of roles can be stored as integer
+    bitsets and added, removed and cancelled with bitwise operations.
+    """
+
+    __slots__ = ("ids", "bits")
+
+    def __init__(self) -> None:
+        self.ids: list[int] = []
+        self.bits: dict[int, int] = {}
+
+    def bit(self, role_id: int) -> int:
+        bit = self.bits.get(role_id)
+        if bit is None:
+            bit = self.bits[role_id] = 1 << len(self.ids)
+            self.ids.append(role_id)
+        return bit
+
+    def mask(self, role_ids: Iterable[int]) -> int:
+        """The bitset of the linked roles in `role_ids`. Other roles are ignored."""
+        mask = 0
+        bits = self.bits
+        for role_id in role_ids:
+            mask |= bits.get(role_id, 0)
+        return mask
+
+    def role_ids(self, mask: int) -> list[int]:
+        """The role IDs in a bitset"""
+        ids: list[int] = []
+        while mask:
+            low = mask & -mask
+            ids.append(self.ids[low.bit_length() - 1])
+            mask ^= low
+        return ids
+
+
+class RoleMasks(NamedTuple):
+    """The linked roles in a guild, split by whether the bot can assign them"""
+
+    assignable: int
+    unassignable: int
+
+
+class CompiledLink:
+    """
+    The parts of a link the voice state pipeline uses, with int IDs, normalised for
+    fast lookups. Much smaller than the Prisma model, which isn't kept.
+    """
+
+    __slots__ = (
+        "id",
+        "type",
+        "linked_roles",
+        "reverse_linked_roles",
+        "linked_mask",
+        "reverse_linked_mask",
+        "suffix",
+        "exclude_channels",
+    )
+
+    def __init__(
+        self,
+        link_id: int,
+        link_type: LinkType,
+        linked_roles: tuple[int, ...],
+        reverse_linked_roles: tuple[int, ...],
+        suffix: str,
+        exclude_channels: frozenset[int],
+        bits: RoleBits,
+    ) -> None:
+        self.id = link_id
+        self.type = link_type
+        self.linked_roles = linked_roles
+        self.reverse_linked_roles = reverse_linked_roles
+        self.linked_mask = union(map(bits.bit, linked_roles))
+        self.reverse_linked_mask = union(map(bits.bit, reverse_linked_roles))
+        self.suffix = suffix
+        self.exclude_channels = exclude_channels
+
+    @classmethod
+    def from_link(cls, link: Link, bits: RoleBits) -> CompiledLink:
+        return cls(
+            int(link.id),
+            LinkType(link.type),
+            role_ids(link.linkedRoles),
+            role_ids(link.reverseLinkedRoles),
+            link.suffix or "",
+            channel_ids(link.excludeChannels),
+            bits,
+        )
+
+    @classmethod
+    def from_row(cls, row: list[Any], bits: RoleBits) -> CompiledLink:
+        link_id, link_type, linked, reverse_linked, suffix, exclude = row
+        return cls(
+            link_id,
+            LinkType(link_type),
+            tuple(linked),
+            tuple(reverse_linked),
+            suffix,
+            channel_ids(exclude),
+            bits,
+        )
+
+    def row(self) -> list[Any]:
+        """The link as a list of JSON serialisable values, for `from_row`"""
+        return [
+            self.id,
+            self.type.value,
+            list(self.linked_roles),
+            list(self.reverse_linked_roles),
+            self.suffix,
+            sorted(self.exclude_channels),
+        ]
+
+
+class ResolvedLinks:
+    """
+    The links which apply to a single channel, with the role changes pre-resolved
+    as bitsets of the guild's `RoleBits`
+    """
+
+    __slots__ = (
+        "links",
+        "join_add",
+        "join_remove",
+        "leave_links",
+        "leave_add",
+        "leave_remove",
+        "permanent_add",
+        "permanent_remove",
+        "join_suffix",
+        "leave_suffix",
+    )
+
+    def __init__(self, links: Iterable[CompiledLink]) -> None:
+        self.links = tuple(links)
+        self.leave_links = tuple(
+            link for link in self.links if link.type != LinkType.PERMANENT
+        )
+
+        self.join_add, self.join_remove = self._cancel(
+            union(link.linked_mask for link in self.links),
+            union(link.reverse_linked_mask for link in self.links),
+        )
+        self.leave_add, self.leave_remove = self._cancel(
+            union(link.reverse_linked_mask for link in self.leave_links),
+            union(link.linked_mask for link in self.leave_links),
+        )
+
+        permanent_links = [
+            link for link in self.links if link.type == LinkType.PERMANENT
+        ]
+        self.permanent_add, self.permanent_remove = self._cancel(
+            union(link.linked_mask for link in permanent_links),
+            union(link.reverse_linked_mask for link in permanent_links),
+        )
+
+        self.join_suffix = SuffixConstructor()
+        for link in self.links:
+            self.join_suffix.add(link.type, link.suffix)
+
+        self.leave_suffix = SuffixConstructor()
+        for link in self.leave_links:
+            self.leave_suffix.add(link.type, link.suffix)
+
+    @staticmethod
+    def _cancel(add: int, remove: int) -> tuple[int, int]:
+        """If a role appears in both sets, remove both instances"""
+        return add & ~remove, remove & ~add
+
+
+class GuildLinkIndex:
+    """All of a guild's links, keyed by the channel, category or guild ID they apply to"""
+
+    __slots__ = ("guild_id", "links", "roles", "voice_roles", "_resolved")
+
+    def __init__(self, guild_id: DiscordID, links: Iterable[Link]) -> None:
+        self.roles = RoleBits()
+        self._build(
+            guild_id, [CompiledLink.from_link(link, self.roles) for link in links]
+        )
+
+    @classmethod
+    def from_rows(
+        cls, guild_id: DiscordID, rows: Iterable[list[Any]]
+    ) -> GuildLinkIndex:
+        """Rebuild an index from the `rows` of another"""
+        index = cls.__new__(cls)
+        index.roles = RoleBits()
+        index._build(guild_id, [CompiledLink.from_row(r, index.roles) for r in rows])
+        return index
+
+    def rows(self) -> list[list[Any]]:
+        return [link.row() for links in self.links.values() for link in links]
+
+    def _build(self, guild_id: DiscordID, compiled: list[CompiledLink]) -> None:
+        self.guild_id = int(guild_id)
+
+        grouped: dict[int, list[CompiledLink]] = {}
+        for link in compiled:
+            grouped.setdefault(link.id, []).append(link)
+
+        self.links: dict[int, tuple[CompiledLink, ...]] = {
+            k: tuple(v) for k, v in grouped.items()
+        }
+
+        # Roles which a member should only have while in a voice channel.
+        # Roles which are also permanent or reverse linked are left out, since
+        # there's no way to tell whether a member should have them.
+        all_links = [link for v in self.links.values() for link in v]
+        permanent = [link for link in all_links if link.type == LinkType.PERMANENT]
+        self.voice_roles = (
+            union(link.linked_mask for link in all_links)
+            & ~union(link.linked_mask for link in permanent)
+            & ~union(link.reverse_linked_mask for link in all_links)
+        )
+        self._resolved: dict[tuple[int, Optional[int]], ResolvedLinks] = {}
+
+    def role_masks(self, guild: discord.Guild) -> RoleMasks:
+        """Split the linked roles by whether the bot can assign them. Deleted roles are in neither."""
+        assignable = unassignable = 0
+        for role_id, bit in self.roles.bits.items():
+            role = guild.get_role(role_id)
+            if role is None:
+                continue
+            if role.is_assignable():
+                assignable |= bit
+            else:
+                unassignable |= bit
+        return RoleMasks(assignable, unassignable)
+
+    def __len__(self) -> int:
+        return sum(len(v) for v in self.links.values())
+
+    def resolve(
+        self, channel_id: DiscordID, category_id: Optional[DiscordID] = None
+    ) -> ResolvedLinks:
+        """Get the links which apply to a channel, skipping any which exclude it"""
+        channel = int(channel_id)
+        category = int(category_id) if category_id else None
+
+        key = (channel, category)
+        resolved = self._resolved.get(key)
+        if resolved is not None:
+            return resolved
+
+        ids = (
+            (channel, category, self.guild_id) if category else (channel, self.guild_id)
+        )
+        resolved = ResolvedLinks(
+            link
+            for i in dict.fromkeys(ids)
+            for link in self.links.get(i, ())
+            if channel not in link.exclude_channels
+        )
+        self._resolved[key] = resolved
+        return resolved
@@ -86,9 +86,11 @@ class LinkingUtils:
         if not interaction.guild_id or not interaction.guild:
             return LinkReturnData(False, "Guild ID not present", None)
 
-        data = await self.client.db.get_channel_linked(
+        data = await self.client.db.find_channel_linked(
             channel.id, interaction.guild_id, link_type
         )
+        if not data:
+            return LinkReturnData(False, "The channel and role are not linked.", None)
 
         if role_category == RoleCategory.REGULAR:
             linked_roles = data.linkedRoles
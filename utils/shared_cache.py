@@ -0,0 +1,228 @@
+from __future__ import annotations
+
+import json
+import logging
+from enum import Enum
+from typing import Any, Iterable, Optional
+
+import redis.asyncio as aioredis
+from prisma.models import GeneratedChannel, Guild, Link, VoiceGenerator
+from pydantic import BaseModel
+from redis.exceptions import RedisError
+
+from utils.cache import MISSING
+from utils.link_index import GuildLinkIndex
+
+log = logging.getLogger(__name__)
+
+
+class RecordCodec:
+    """
+    Converts a Prisma record to and from a list of its field values, in a fixed order,
+    followed by its included relations. Much smaller than the record as a JSON object.
+    """
+
+    def __init__(
+        self,
+        model: type[BaseModel],
+        fields: tuple[str, ...],
+        relations: Optional[dict[str, tuple[RecordCodec, bool]]] = None,
+    ) -> None:
+        self.model = model
+        self.fields = fields
+        # Relation name -> (codec, whether it is a list)
+        self.relations = relations or {}
+
+    def dump(self, record: Any) -> list[Any]:
+        data = [getattr(record, f) for f in self.fields]
+        for name, (codec, many) in self.relations.items():
+            value = getattr(record, name, None)
+            if value is None:
+                data.append(None)
+            elif many:
+                data.append([codec.dump(v) for v in value])
+            else:
+                data.append(codec.dump(value))
+        return data
+
+    def load(self, data: list[Any]) -> Any:
+        values = dict(zip(self.fields, data))
+        for (name, (codec, many)), value in zip(
+            self.relations.items(), data[len(self.fields) :]
+        ):
+            if value is None:
+                values[name] = None
+            elif many:
+                values[name] = [codec.load(v) for v in value]
+            else:
+                values[name] = codec.load(value)
+        return self.model.model_validate(values)
+
+
+GUILD = RecordCodec(
+    Guild,
+    (
+        "id",
+        "ttsEnabled",
+        "ttsRole",
+        "ttsLeave",
+        "logging",
+        "premium",
+        "botMasterRoles",
+        "analytics",
+        "premiumId",
+    ),
+)
+LINK = RecordCodec(
+    Link,
+    (
+        "dbId",
+        "id",
+        "type",
+        "guildId",
+        "linkedRoles",
+        "reverseLinkedRoles",
+        "suffix",
+        "speakerRoles",
+        "excludeChannels",
+    ),
+)
+GENERATED_CHANNEL = RecordCodec(
+    GeneratedChannel,
+    (
+        "id",
+        "channelId",
+        "ownerId",
+        "textChannelId",
+        "voiceGeneratorId",
+        "userEditable",
+    ),
+)
+VOICE_GENERATOR = RecordCodec(
+    VoiceGenerator,
+    (
+        "id",
+        "guildId",
+        "categoryId",
+        "generatorId",
+        "interfaceChannel",
+        "interfaceMessage",
+        "type",
+        "defaultOptions",
+        "defaultUserLimit",
+        "channelLimit",
+        "defaultRole",
+        "channelName",
+        "restrictRole",
+        "hideAtLimit",
+    ),
+    {"openChannels": (GENERATED_CHANNEL, True)},
+)
+GENERATED_CHANNEL.relations["VoiceGenerator"] = (VOICE_GENERATOR, False)
+
+
+class LinkIndexCodec:
+    """Converts a guild's link index to and from its guild ID and compact link rows"""
+
+    def dump(self, index: GuildLinkIndex) -> list[Any]:
+        return [index.guild_id, index.rows()]
+
+    def load(self, data: list[Any]) -> GuildLinkIndex:
+        return GuildLinkIndex.from_rows(data[0], data[1])
+
+
+# The cached functions' values, by the name of their cache: (codec, whether it is a list)
+CODECS: dict[str, tuple[RecordCodec | LinkIndexCodec, bool]] = {
+    "guild_cache": (GUILD, False),
+    "linked_channel_cache": (LINK, False),
+    "find_linked_channel_cache": (LINK, False),
+    "all_links_cache": (LINK, True),
+    "link_index_cache": (LinkIndexCodec(), False),
+    "get_generators_cache": (VOICE_GENERATOR, True),
+    "generator_cache": (VOICE_GENERATOR, False),
+    "generated_channel_cache": (GENERATED_CHANNEL, False),
+}
+
+
+class SharedCache:
+    """
+    A second cache tier in Redis, shared by every process, behind each process's TTLCaches.
+    Saves a process with empty caches, such as after a restart, from loading everything
+    from the database again.
+    """
+
+    # Bumped whenever a codec changes, so old entries are ignored
+    version = 1
+
+    def __init__(
+        self,
+        ar: aioredis.Redis[Any],
+        ttl: int = 60 * 60,
+        ttls: Optional[dict[str, int]] = None,
+    ) -> None:
+        self.ar = ar
+        self.ttl = ttl
+        # Per cache overrides of the TTL, in seconds
+        self.ttls = ttls or {}
+        self.errors = 0
+
+    def key(self, name: str, args: Iterable[Any]) -> str:
+        # IDs are cached as both ints and strings, but share a key here
+        parts = [str(a.value if isinstance(a, Enum) else a) for a in args]
+        return f"cache:v{self.version}:{name}:" + ":".join(parts)
+
+    async def get(self, name: str, key: str) -> Any:
+        codec, many = CODECS[name]
+        try:
+            data = await self.ar.get(key)
+        except RedisError as e:
+            self.errors += 1
+            log.error(f"Failed to read {key} from the shared cache: {e}")
+            return MISSING
+
+        if data is None:
+            return MISSING
+
+        try:
+            value = json.loads(data)
+            if value is None:
+                return None
+            if many:
+                return [codec.load(v) for v in value]
+            return codec.load(value)
+        except ValueError as e:
+            # pydantic's ValidationError is a ValueError too
+            self.errors += 1
+            log.error(f"Invalid shared cache entry {key}: {e}")
+            return MISSING
+
+    async def set(self, name: str, key: str, value: Any) -> None:
+        codec, many = CODECS[name]
+        if value is None:
+            data = None
+        elif many:
+            data = [codec.dump(v) for v in value]
+        else:
+            data = codec.dump(value)
+
+        try:
+            await self.ar.set(
+                key,
+                json.dumps(data, separators=(",", ":"), default=str),
+                ex=self.ttls.get(name, self.ttl),
+            )
+        except RedisError as e:
+            self.errors += 1
+            log.error(f"Failed to write {key} to the shared cache: {e}")
+
+    async def delete(self, keys: Iterable[tuple[Any, ...]]) -> None:
+        """Remove keys, each the cache's name followed by the function's arguments"""
+        redis_keys = {self.key(name, args) for name, *args in keys if name in CODECS}
+        if not redis_keys:
+            return
+
+        try:
+            await self.ar.delete(*redis_keys)
+        except RedisError as e:
+            self.errors += 1
+            log.error(f"Failed to delete from the shared cache: {e}")
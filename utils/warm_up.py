@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import TYPE_CHECKING, Optional
+
+import discord
+
+import config
+from utils.types import LogLevel
+
+if TYPE_CHECKING:
+    from utils.client import VCRolesClient
+
+
+class CacheWarmUp:
+    """
+    Fills the caches for a shard's guilds when it becomes ready, in batched queries,
+    so the first voice event in each guild doesn't have to wait for the database.
+    """
+
+    def __init__(self, client: VCRolesClient) -> None:
+        self.client = client
+        self.enabled: bool = getattr(config, "WARM_UP_ENABLED", True)
+        # Guilds loaded per query, and queries run at once across every shard
+        self.batch_size: int = getattr(config, "WARM_UP_BATCH_SIZE", 100)
+        self.semaphore = asyncio.Semaphore(getattr(config, "WARM_UP_CONCURRENCY", 2))
+        self.tasks: dict[int, asyncio.Task[None]] = {}
+        self.warmed = 0
+
+    def start(self, shard_id: Optional[int]) -> None:
+        if not self.enabled:
+            return
+
+        shard_id = shard_id or 0
+        task = self.tasks.pop(shard_id, None)
+        if task is not None:
+            task.cancel()
+
+        task = self.client.loop.create_task(self.run(shard_id))
+        self.tasks[shard_id] = task
+        task.add_done_callback(lambda t: self.finished(shard_id, t))
+
+    def finished(self, shard_id: int, task: asyncio.Task[None]) -> None:
+        if self.tasks.get(shard_id) is task:
+            del self.tasks[shard_id]
+
+    def stop(self) -> None:
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks.clear()
+
+    async def wait(self, shard_id: int) -> None:
+        """Wait for a shard's warm-up to finish, if it is running"""
+        task = self.tasks.get(shard_id)
+        if task is not None:
+            await asyncio.wait([task])
+
+    async def run(self, shard_id: int) -> None:
+        guilds = [
+            g
+            for g in self.client.guilds
+            if (g.shard_id or 0) == shard_id and not self.client.db.is_warm(g.id)
+        ]
+        batches = [
+            guilds[i : i + self.batch_size]
+            for i in range(0, len(guilds), self.batch_size)
+        ]
+
+        start = time.perf_counter()
+        found = sum(await asyncio.gather(*map(self.batch, batches)))
+        self.client.log(
+            LogLevel.DEBUG,
+            f"Warmed up {found}/{len(guilds)} guilds in {len(batches)} batches"
+            f" in {time.perf_counter() - start:.2f}s s/{shard_id}",
+        )
+
+    async def batch(self, guilds: list[discord.Guild]) -> int:
+        channel_ids = {
+            g.id: [c.id for c in g.voice_channels + g.stage_channels] for g in guilds
+        }
+        async with self.semaphore:
+            try:
+                found = await self.client.db.warm_up(list(channel_ids), channel_ids)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.client.log(LogLevel.ERROR, f"Failed to warm up guilds: {e}")
+                return 0
+
+        self.warmed += found
+        return found
@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+import asyncio
+from typing import TYPE_CHECKING, Optional
+
+import discord
+from redis.asyncio.client import Pipeline
+from redis.exceptions import RedisError
+
+import config
+from utils.types import LogLevel
+from voicestate.reconciler import ChannelKey, channel_key
+from voicestate.scheduler import EditPriority
+from voicestate.snapshot import MemberSnapshot
+
+if TYPE_CHECKING:
+    from cogs.voicestate import VoiceState
+
+
+class CatchUp:
+    """
+    Reconciles members after voice events may have been missed, such as while the bot
+    was offline or a shard was disconnected.
+
+    Members in voice are reconciled against the channel they are in now. Members who
+    left voice while events were missed are found from the set of members last seen in
+    voice in each guild, plus any cached members who still hold voice-only roles.
+    Edits are sent through the scheduler at the lowest priority, so live events go first.
+    """
+
+    def __init__(self, cog: VoiceState) -> None:
+        self.cog = cog
+        self.client = cog.client
+        self.enabled: bool = getattr(config, "CATCH_UP_ENABLED", True)
+        # The number of edits a guild can have queued before catch-up waits for it to drain
+        self.max_backlog: int = getattr(config, "CATCH_UP_MAX_BACKLOG", 20)
+        # Delay between members which have to be fetched, and between guilds
+        self.fetch_delay: float = getattr(config, "CATCH_UP_FETCH_DELAY", 0.2)
+        self.guild_delay: float = getattr(config, "CATCH_UP_GUILD_DELAY", 0.05)
+        self.tasks: dict[int, asyncio.Task[None]] = {}
+        self.submitted = 0
+
+    @staticmethod
+    def voice_members_key(guild_id: int) -> str:
+        return f"voice_members:{guild_id}"
+
+    def track(
+        self,
+        pipe: Pipeline,
+        member: MemberSnapshot,
+        before: Optional[ChannelKey],
+        after: Optional[ChannelKey],
+    ) -> None:
+        """
+        Queue recording whether a member is in voice on a pipeline, so leaves can be
+        found after downtime
+        """
+        if (before is None) == (after is None):
+            return
+
+        key = self.voice_members_key(member.guild.id)
+        if after is not None:
+            pipe.sadd(key, member.id)
+        else:
+            pipe.srem(key, member.id)
+
+    def start(self, shard_id: Optional[int]) -> None:
+        """Start catching up a shard, restarting it if it is already running"""
+        if not self.enabled:
+            return
+
+        shard_id = shard_id or 0
+        self.stop(shard_id)
+        task = self.client.loop.create_task(self.run(shard_id))
+        self.tasks[shard_id] = task
+        task.add_done_callback(lambda t: self.finished(shard_id, t))
+
+    def finished(self, shard_id: int, task: asyncio.Task[None]) -> None:
+        if self.tasks.get(shard_id) is task:
+            del self.tasks[shard_id]
+
+    def stop(self, shard_id: Optional[int] = None) -> None:
+        """Cancel catching up a shard, or every shard if `shard_id` is None"""
+        shard_ids = list(self.tasks) if shard_id is None else [shard_id]
+        for i in shard_ids:
+            task = self.tasks.pop(i, None)
+            if task is not None:
+                task.cancel()
+
+    async def run(self, shard_id: int) -> None:
+        # Catching up loads every guild's links, so let the warm-up batch them first
+        await self.client.warm_up.wait(shard_id)
+
+        guilds = [g for g in self.client.guilds if (g.shard_id or 0) == shard_id]
+        self.client.log(
+            LogLevel.DEBUG, f"Catching up {len(guilds)} guilds s/{shard_id}"
+        )
+
+        for guild in guilds:
+            try:
+                await self.guild(guild)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.client.log(
+                    LogLevel.ERROR, f"Error catching up guild g/{guild.id}: {e}"
+                )
+            await asyncio.sleep(self.guild_delay)
+
+        self.client.log(LogLevel.DEBUG, f"Finished catching up s/{shard_id}")
+
+    async def guild(self, guild: discord.Guild) -> None:
+        """Reconcile every member of a guild who might have missed a voice event"""
+        in_voice: dict[int, ChannelKey] = {}
+        for channel in [*guild.voice_channels, *guild.stage_channels]:
+            key = channel_key(channel)
+            for member_id in channel.voice_states:
+                in_voice[member_id] = key
+
+        index = await self.client.db.get_link_index(guild.id)
+
+        redis_key = self.voice_members_key(guild.id)
+        try:
+            last_seen = {int(m) for m in await self.client.ar.smembers(redis_key)}
+        except RedisError as e:
+            self.client.log(LogLevel.ERROR, f"Failed to read voice members: {e}")
+            last_seen = set()
+
+        if not len(index):
+            await self.update_voice_members(guild, redis_key, in_voice, last_seen)
+            return
+
+        voice_role_ids = index.roles.role_ids(index.voice_roles)
+        candidates = dict.fromkeys(in_voice)
+        candidates.update(dict.fromkeys(last_seen))
+        if voice_role_ids:
+            for member in guild.members:
+                if any(member.get_role(r) for r in voice_role_ids):
+                    candidates[member.id] = None
+
+        for member_id in candidates:
+            if member_id in self.cog.member_queues.get(guild.id, {}):
+                # Already being reconciled from a live event
+                continue
+
+            scheduled = self.cog.scheduler.guilds.get(guild.id)
+            if scheduled is not None and member_id in scheduled.jobs:
+                continue
+
+            while self.cog.scheduler.depth(guild.id) >= self.max_backlog:
+                await asyncio.sleep(1)
+
+            member = guild.get_member(member_id)
+            if member is None:
+                await asyncio.sleep(self.fetch_delay)
+                try:
+                    member = await guild.fetch_member(member_id)
+                except discord.HTTPException:
+                    continue
+                state = self.cog.member_state.update(member)
+            else:
+                # The cached member is kept up to date by the gateway, so only the
+                # tracker's newer edit results are worth preferring over it
+                state = await self.cog.get_member_state(member, fetch=False)
+
+            if member.bot:
+                continue
+
+            # Their voice channel may have changed while fetching
+            current = channel_key(member.voice.channel) if member.voice else None
+            if member_id in self.cog.member_queues.get(guild.id, {}):
+                continue
+
+            edit = self.cog.reconciler.catch_up(guild, index, member_id, state, current)
+            if edit is not None:
+                self.cog.scheduler.submit(
+                    MemberSnapshot(member), edit, EditPriority.CATCH_UP
+                )
+                self.submitted += 1
+
+            # Let live events through between members
+            await asyncio.sleep(0)
+
+        await self.update_voice_members(guild, redis_key, in_voice, last_seen)
+
+    async def update_voice_members(
+        self,
+        guild: discord.Guild,
+        redis_key: str,
+        in_voice: dict[int, ChannelKey],
+        last_seen: set[int],
+    ) -> None:
+        """Replace the members last seen in voice with those in voice now"""
+        # Members who moved since the start are tracked by their live event
+        left = [m for m in last_seen - in_voice.keys() if not self.in_voice(guild, m)]
+        joined = [m for m in in_voice if self.in_voice(guild, m)]
+        try:
+            async with self.client.ar.pipeline(transaction=False) as pipe:
+                if left:
+                    pipe.srem(redis_key, *left)
+                if joined:
+                    pipe.sadd(redis_key, *joined)
+                await pipe.execute()
+        except RedisError as e:
+            self.client.log(LogLevel.ERROR, f"Failed to update voice members: {e}")
+
+    @staticmethod
+    def in_voice(guild: discord.Guild, member_id: int) -> bool:
+        member = guild.get_member(member_id)
+        return bool(member and member.voice and member.voice.channel)
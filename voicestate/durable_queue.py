@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, AsyncIterator, Iterable, Optional
+
+from redis.asyncio.client import Pipeline
+from redis.exceptions import RedisError
+
+import config
+from utils.types import LogLevel
+from voicestate.reconciler import ChannelKey
+from voicestate.snapshot import MemberSnapshot
+
+if TYPE_CHECKING:
+    from utils.client import VCRolesClient
+
+
+def encode_key(key: Optional[ChannelKey]) -> str:
+    if key is None:
+        return ""
+    return f"{key[0]}:{key[1] or ''}"
+
+
+def decode_key(value: str) -> Optional[ChannelKey]:
+    if not value:
+        return None
+    channel_id, _, category_id = value.partition(":")
+    return int(channel_id), int(category_id) if category_id else None
+
+
+class DurableEntry:
+    """A voice channel move read back from the stream"""
+
+    __slots__ = ("entry_id", "guild_id", "member_id", "before", "after")
+
+    def __init__(self, entry_id: str, fields: dict[str, str]) -> None:
+        self.entry_id = entry_id
+        self.guild_id = int(fields["g"])
+        self.member_id = int(fields["m"])
+        self.before = decode_key(fields.get("b", ""))
+        self.after = decode_key(fields.get("a", ""))
+
+
+class DurableEditQueue:
+    """
+    Persists the voice channel moves of members whose roles haven't been reconciled yet
+    to a Redis stream per shard, so they can be replayed after a crash or restart.
+
+    Entries are deleted (acknowledged) once the edit covering them has been sent or
+    found to be unnecessary. Reconciling is idempotent, so replaying an entry whose
+    edit was already applied doesn't change anything.
+    """
+
+    def __init__(self, client: VCRolesClient) -> None:
+        self.client = client
+        self.max_length: int = getattr(config, "DURABLE_QUEUE_MAX_LENGTH", 100_000)
+
+    @staticmethod
+    def stream(shard_id: Optional[int]) -> str:
+        return f"voice_edits:{shard_id or 0}"
+
+    def add(
+        self,
+        pipe: Pipeline,
+        member: MemberSnapshot,
+        before: Optional[ChannelKey],
+        after: Optional[ChannelKey],
+    ) -> None:
+        """Queue persisting a move on a pipeline, whose result is the stream entry's ID"""
+        pipe.xadd(
+            self.stream(member.guild.shard_id),
+            {
+                "g": member.guild.id,
+                "m": member.id,
+                "b": encode_key(before),
+                "a": encode_key(after),
+            },
+            maxlen=self.max_length,
+            approximate=True,
+        )
+
+    async def ack(self, shard_id: Optional[int], entry_ids: Iterable[str]) -> None:
+        """Remove entries whose edits have been completed"""
+        entry_ids = list(entry_ids)
+        if not entry_ids:
+            return
+
+        try:
+            await self.client.ar.xdel(self.stream(shard_id), *entry_ids)
+        except RedisError as e:
+            self.client.log(LogLevel.ERROR, f"Failed to ack voice edits: {e}")
+
+    async def replay(
+        self, shard_id: Optional[int], until: str = "+", batch_size: int = 500
+    ) -> AsyncIterator[DurableEntry]:
+        """Read back every unacknowledged entry for a shard up to `until`, oldest first"""
+        stream = self.stream(shard_id)
+        start = "-"
+        while True:
+            entries = await self.client.ar.xrange(
+                stream, start, until, count=batch_size
+            )
+            if not entries:
+                return
+
+            for entry_id, fields in entries:
+                yield DurableEntry(entry_id, fields)
+
+            # Exclusive start from the last entry read
+            start = "(" + entries[-1][0]
@@ -234,10 +234,14 @@ class Generator:
             return
 
         if not voice_channel.members:
+            # Their generated channel row is removed below, and only their links when
+            # the deletions come back as events
+            self.client.channel_cleanup.ignore(voice_channel.id)
             await voice_channel.delete()
             if data.textChannelId:
                 text_channel = self.client.get_channel(int(data.textChannelId))
                 if text_channel and isinstance(text_channel, discord.TextChannel):
+                    self.client.channel_cleanup.ignore(text_channel.id)
                     await text_channel.delete()
 
             await self.client.db.delete_generated_channel(voice_channel.id)
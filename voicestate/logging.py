@@ -6,6 +6,7 @@ import discord
 from prisma.enums import LinkType
 from utils.client import VCRolesClient
 from utils.types import LinkableChannel, LogLevel, VoiceStateReturnData
+from voicestate.snapshot import MemberSnapshot
 
 
 class Logging:
@@ -117,7 +118,7 @@ class Logging:
     async def log_join(
         self,
         user_channel: LinkableChannel,
-        member: discord.Member,
+        member: MemberSnapshot,
         roles_changed: list[VoiceStateReturnData],
         failed_roles: list[discord.Role],
     ) -> None:
@@ -162,7 +163,7 @@ class Logging:
     async def log_leave(
         self,
         user_channel: LinkableChannel,
-        member: discord.Member,
+        member: MemberSnapshot,
         roles_changed: list[VoiceStateReturnData],
         failed_roles: list[discord.Role],
     ) -> None:
@@ -207,7 +208,7 @@ class Logging:
         self,
         user_before_channel: LinkableChannel,
         user_after_channel: LinkableChannel,
-        member: discord.Member,
+        member: MemberSnapshot,
         leave_roles_changed: list[VoiceStateReturnData],
         join_roles_changed: list[VoiceStateReturnData],
         failed_roles: list[discord.Role],
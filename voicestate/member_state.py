@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import time
+from typing import Any, Optional, Union
+
+import discord
+from cachetools import TTLCache
+
+import config
+from voicestate.snapshot import MemberSnapshot
+
+
+class MemberState:
+    """The nickname and roles of a member at a point in time"""
+
+    __slots__ = ("display_name", "role_ids", "updated_at")
+
+    def __init__(
+        self, display_name: str, role_ids: tuple[int, ...], updated_at: float
+    ) -> None:
+        self.display_name = display_name
+        # excludes @everyone
+        self.role_ids = role_ids
+        # When the payload it came from was received, from time.monotonic()
+        self.updated_at = updated_at
+
+
+class MemberStateTracker:
+    """
+    Tracks the nickname and roles of members from the gateway payloads and edit
+    responses we already receive, so they don't have to be fetched over REST.
+    Whichever was received last is kept, so changes made by others since our last
+    edit are picked up from the next voice event.
+    """
+
+    def __init__(self) -> None:
+        self.max_age: float = getattr(config, "MEMBER_STATE_MAX_AGE", 60 * 10)
+        self.states: TTLCache[Any, MemberState] = TTLCache(2**16, self.max_age)
+        self.hits = 0
+        self.fallbacks = 0
+
+    def get(self, guild_id: int, member_id: int) -> Optional[MemberState]:
+        """Get the tracked state of a member, or None if it is missing or stale"""
+        state = self.states.get((guild_id, member_id))
+        if state is not None:
+            self.hits += 1
+        return state
+
+    def update(self, member: Union[discord.Member, MemberSnapshot]) -> MemberState:
+        """Record the state of a member, unless a newer one is tracked. Returns the newest."""
+        if isinstance(member, MemberSnapshot):
+            role_ids, updated_at = member.role_ids, member.taken_at
+        else:
+            role_ids, updated_at = tuple(member._roles), time.monotonic()
+
+        key = (member.guild.id, member.id)
+        state = self.states.get(key)
+        if state is not None and state.updated_at > updated_at:
+            return state
+
+        state = MemberState(member.display_name, role_ids, updated_at)
+        self.states[key] = state
+        return state
+
+    def update_from_payload(
+        self, guild_id: int, member_id: int, payload: dict[str, Any]
+    ) -> MemberState:
+        """Record the state of a member from a member payload returned by the API"""
+        user = payload.get("user", {})
+        state = MemberState(
+            payload.get("nick") or user.get("global_name") or user.get("username", ""),
+            tuple(map(int, payload.get("roles", ()))),
+            time.monotonic(),
+        )
+        self.states[(guild_id, member_id)] = state
+        return state
@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+from typing import Any, NamedTuple, Optional
+
+import discord
+from cachetools import TTLCache
+
+import config
+from utils.link_index import GuildLinkIndex, ResolvedLinks, RoleMasks
+from voicestate.member_state import MemberState
+from voicestate.snapshot import MemberSnapshot
+
+ChannelKey = tuple[int, Optional[int]]
+
+
+def channel_key(channel: Optional[discord.abc.GuildChannel]) -> Optional[ChannelKey]:
+    """The channel and category ID used to resolve a channel's links"""
+    if channel is None:
+        return None
+    return channel.id, channel.category.id if channel.category else None
+
+
+class PendingMember:
+    """A member whose voice channel has changed since their roles were last reconciled"""
+
+    __slots__ = ("member", "left", "joined", "current", "entry_ids")
+
+    def __init__(self, member: MemberSnapshot) -> None:
+        self.member = member
+        self.left: set[ChannelKey] = set()
+        self.joined: set[ChannelKey] = set()
+        self.current: Optional[ChannelKey] = None
+        # The durable queue entries to acknowledge once the member is reconciled
+        self.entry_ids: list[str] = []
+
+    def move(self, before: Optional[ChannelKey], after: Optional[ChannelKey]) -> None:
+        """Record a join, leave or change"""
+        if before is not None:
+            self.left.add(before)
+        if after is not None:
+            self.joined.add(after)
+        self.current = after
+
+    def absorb(self, older: PendingMember) -> None:
+        """Add the moves of an older pending member which haven't been applied yet"""
+        self.left |= older.left
+        self.joined |= older.joined
+
+
+class MemberEdit(NamedTuple):
+    """The edit needed to bring a member to their desired state"""
+
+    roles: Optional[list[int]]
+    nick: Optional[str]
+    added: int
+    removed: int
+
+
+class MemberReconciler:
+    """Computes the roles and nickname a member should have from their current voice channel"""
+
+    def __init__(self) -> None:
+        # Which linked roles the bot can assign in each guild, with the index they were computed for
+        self.role_masks: TTLCache[Any, tuple[GuildLinkIndex, RoleMasks]] = TTLCache(
+            2**13, getattr(config, "ROLE_MASK_MAX_AGE", 60 * 10)
+        )
+
+    def get_role_masks(self, guild: discord.Guild, index: GuildLinkIndex) -> RoleMasks:
+        cached = self.role_masks.get(guild.id)
+        if cached is not None and cached[0] is index:
+            return cached[1]
+
+        masks = index.role_masks(guild)
+        self.role_masks[guild.id] = (index, masks)
+        return masks
+
+    def invalidate_roles(self, guild_id: int) -> None:
+        """Recompute which roles are assignable, after roles or the bot's roles change"""
+        self.role_masks.pop(guild_id, None)
+
+    @staticmethod
+    def desired_roles(
+        left: list[ResolvedLinks],
+        joined: list[ResolvedLinks],
+        current: Optional[ResolvedLinks],
+    ) -> tuple[int, int]:
+        """
+        The roles which should be added and removed after leaving `left`, passing through `joined`
+        and ending up in `current`, as bitsets
+        """
+        add = remove = 0
+        for resolved in left:
+            add |= resolved.leave_add
+            remove |= resolved.leave_remove
+
+        # if a role appears in both sets, remove both instances
+        add, remove = add & ~remove, remove & ~add
+
+        # permanent links keep their roles after leaving
+        for resolved in joined:
+            add = (add & ~resolved.permanent_remove) | resolved.permanent_add
+            remove = (remove & ~resolved.permanent_add) | resolved.permanent_remove
+
+        # the current channel takes priority over any channel that was left
+        if current is not None:
+            add = (add & ~current.join_remove) | current.join_add
+            remove = (remove & ~current.join_add) | current.join_remove
+
+        return add, remove
+
+    @staticmethod
+    def desired_nickname(
+        display_name: str,
+        left: list[ResolvedLinks],
+        joined: list[ResolvedLinks],
+        current: Optional[ResolvedLinks],
+    ) -> str:
+        """
+        The nickname a member should have after leaving `left`, passing through `joined`
+        and ending up in `current`
+        """
+        nick = display_name
+        for resolved in left:
+            suffix = resolved.leave_suffix.suffix
+            if suffix:
+                nick = nick.removesuffix(suffix).rstrip()
+
+        # permanent suffixes are kept after leaving
+        addable_suffixes = [
+            resolved.join_suffix.permanent_suffix
+            for resolved in joined
+            if resolved is not current
+        ]
+        if current is not None:
+            suffix_data = current.join_suffix
+            addable_suffixes.append(
+                f"{suffix_data.permanent_suffix + ' ' if suffix_data.permanent_suffix else ''}{suffix_data.suffix}"
+            )
+
+        for addable_suffix in addable_suffixes:
+            addable_suffix = addable_suffix.strip()
+            if addable_suffix and not nick.endswith(addable_suffix):
+                new_nick = f"{nick} {addable_suffix}"
+                if len(new_nick) <= 32:
+                    nick = new_nick
+
+        return nick
+
+    def reconcile(
+        self,
+        guild: discord.Guild,
+        index: GuildLinkIndex,
+        pending: PendingMember,
+        state: MemberState,
+    ) -> Optional[MemberEdit]:
+        """Compare a member's desired state with their actual state. Returns None if nothing differs."""
+        left = [index.resolve(*key) for key in pending.left]
+        joined = [index.resolve(*key) for key in pending.joined]
+        current = index.resolve(*pending.current) if pending.current else None
+
+        add, remove = self.desired_roles(left, joined, current)
+
+        desired_nick = self.desired_nickname(state.display_name, left, joined, current)
+
+        return self.build_edit(
+            guild, index, pending.member.id, state, add, remove, desired_nick
+        )
+
+    def catch_up(
+        self,
+        guild: discord.Guild,
+        index: GuildLinkIndex,
+        member_id: int,
+        state: MemberState,
+        current: Optional[ChannelKey],
+    ) -> Optional[MemberEdit]:
+        """
+        Compare a member's desired state with their actual state using only the channel
+        they are in now, for when their voice events have been missed.
+        Returns None if nothing differs.
+        """
+        resolved = index.resolve(*current) if current else None
+
+        add = resolved.join_add if resolved else 0
+        remove = index.voice_roles & ~add
+        if resolved is not None:
+            remove |= resolved.join_remove
+            desired_nick = self.desired_nickname(
+                state.display_name, [], [resolved], resolved
+            )
+        else:
+            desired_nick = state.display_name
+
+        return self.build_edit(
+            guild, index, member_id, state, add, remove, desired_nick
+        )
+
+    def build_edit(
+        self,
+        guild: discord.Guild,
+        index: GuildLinkIndex,
+        member_id: int,
+        state: MemberState,
+        add: int,
+        remove: int,
+        desired_nick: str,
+    ) -> Optional[MemberEdit]:
+        assignable = self.get_role_masks(guild, index).assignable
+        actual = index.roles.mask(state.role_ids)
+        desired = (actual | (add & assignable)) & ~(remove & assignable)
+
+        nick: Optional[str] = None
+        # The owner can't have their nickname changed
+        if guild.owner_id != member_id and desired_nick != state.display_name:
+            nick = desired_nick
+
+        if desired == actual and nick is None:
+            return None
+
+        roles: Optional[list[int]] = None
+        added, removed = desired & ~actual, actual & ~desired
+        if desired != actual:
+            removed_ids = index.roles.role_ids(removed)
+            roles = [r for r in state.role_ids if r not in removed_ids]
+            roles += index.roles.role_ids(added)
+
+        return MemberEdit(
+            roles=roles,
+            nick=nick,
+            added=added.bit_count(),
+            removed=removed.bit_count(),
+        )
@@ -0,0 +1,331 @@
+from __future__ import annotations
+
+import asyncio
+import enum
+import itertools
+import random
+import time
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Optional
+
+import aiohttp
+import discord
+
+import config
+from utils.types import LogLevel
+from voicestate.reconciler import MemberEdit, PendingMember
+from voicestate.snapshot import MemberSnapshot
+
+if TYPE_CHECKING:
+    from utils.client import VCRolesClient
+
+EditCallback = Callable[["EditJob"], Awaitable[Any]]
+FinishedCallback = Callable[["EditJob"], Any]
+
+
+class EditPriority(enum.IntEnum):
+    """The order member edits are sent in, lowest first"""
+
+    MEMBERSHIP = 0  # joining or leaving voice
+    CHANGE = 1  # moving between channels
+    NICKNAME = 2  # cosmetic nickname-only edits
+    CATCH_UP = 3  # corrections for voice events missed while offline
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second, with bursts of up to `capacity`"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated_at) * self.rate
+            )
+            self.updated_at = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def is_retryable(error: Exception) -> bool:
+    """Whether a failed edit might succeed if it is sent again"""
+    if isinstance(error, (discord.Forbidden, discord.NotFound)):
+        # Missing permissions, unknown member or unknown role
+        return False
+    if isinstance(error, discord.HTTPException):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, OSError))
+
+
+class GuildFailures:
+    """Counts of the failed edits in a guild"""
+
+    __slots__ = ("retried", "permanent", "gave_up", "last_error")
+
+    def __init__(self) -> None:
+        self.retried = 0
+        self.permanent = 0
+        self.gave_up = 0
+        self.last_error = ""
+
+
+class EditStats:
+    """Wait times of the edits which have been sent"""
+
+    __slots__ = ("sent", "total_wait", "last_wait", "max_wait")
+
+    def __init__(self) -> None:
+        self.sent = 0
+        self.total_wait = 0.0
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float) -> None:
+        self.sent += 1
+        self.total_wait += wait
+        self.last_wait = wait
+        self.max_wait = max(self.max_wait, wait)
+
+
+class EditJob:
+    """
+    A queued member edit. The callback reconciles the member again when it is sent,
+    so `edit` is only what was needed when the job was queued, and None if nothing was.
+    """
+
+    __slots__ = (
+        "priority",
+        "seq",
+        "member",
+        "edit",
+        "pending",
+        "entry_ids",
+        "queued_at",
+        "attempts",
+    )
+
+    def __init__(
+        self,
+        priority: EditPriority,
+        seq: int,
+        member: MemberSnapshot,
+        edit: Optional[MemberEdit],
+        pending: Optional[PendingMember],
+        entry_ids: list[str],
+    ) -> None:
+        self.priority = priority
+        self.seq = seq
+        self.member = member
+        self.edit = edit
+        # The voice moves to reconcile, or None to reconcile against the current channel
+        self.pending = pending
+        self.entry_ids = entry_ids
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+
+    def __lt__(self, other: EditJob) -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class GuildEditScheduler:
+    """Sends the member edits for a single guild, within the guild's member edit rate limit"""
+
+    def __init__(self, scheduler: EditScheduler) -> None:
+        self.scheduler = scheduler
+        self.bucket = TokenBucket(scheduler.rate, scheduler.burst)
+        self.queue: asyncio.PriorityQueue[EditJob] = asyncio.PriorityQueue()
+        # The latest job for each member, including any being sent or waiting to be retried
+        self.jobs: dict[int, EditJob] = {}
+        self.workers: set[asyncio.Task[None]] = set()
+
+    def submit(self, job: EditJob) -> None:
+        # A newer edit for the same member replaces any which hasn't been sent yet
+        old_job = self.jobs.get(job.member.id)
+        if old_job is not None:
+            job.entry_ids = old_job.entry_ids + job.entry_ids
+            if job.pending is not None and old_job.pending is not None:
+                job.pending.absorb(old_job.pending)
+        self.jobs[job.member.id] = job
+        self.enqueue(job)
+
+    def enqueue(self, job: EditJob) -> None:
+        if self.jobs.get(job.member.id) is not job:
+            # Replaced while waiting to be retried
+            return
+
+        self.queue.put_nowait(job)
+
+        if len(self.workers) < self.scheduler.max_workers:
+            worker = asyncio.get_running_loop().create_task(self.work())
+            self.workers.add(worker)
+            worker.add_done_callback(self.workers.discard)
+
+    def finish(self, job: EditJob) -> None:
+        if self.jobs.get(job.member.id) is job:
+            del self.jobs[job.member.id]
+            if self.scheduler.on_finished is not None:
+                self.scheduler.on_finished(job)
+
+    async def work(self) -> None:
+        while not self.queue.empty():
+            job = self.queue.get_nowait()
+            try:
+                if self.jobs.get(job.member.id) is not job:
+                    continue
+
+                await self.bucket.acquire()
+                if self.jobs.get(job.member.id) is not job:
+                    continue
+
+                self.scheduler.edit_stats.record(time.monotonic() - job.queued_at)
+
+                try:
+                    await self.scheduler.callback(job)
+                except Exception as e:
+                    delay = self.scheduler.handle_failure(job, e)
+                    if delay is None:
+                        self.finish(job)
+                    else:
+                        job.attempts += 1
+                        asyncio.get_running_loop().call_later(delay, self.enqueue, job)
+                else:
+                    self.finish(job)
+            finally:
+                self.queue.task_done()
+
+    @property
+    def depth(self) -> int:
+        return len(self.jobs)
+
+    @property
+    def idle(self) -> bool:
+        """Whether the guild has nothing queued and its rate limit has fully recovered"""
+        return (
+            not self.jobs
+            and not self.workers
+            and time.monotonic() - self.bucket.updated_at
+            >= self.bucket.capacity / self.bucket.rate
+        )
+
+
+class EditScheduler:
+    """Schedules member edits per guild, in priority order and with bounded concurrency"""
+
+    def __init__(
+        self,
+        client: VCRolesClient,
+        callback: EditCallback,
+        on_finished: Optional[FinishedCallback] = None,
+    ) -> None:
+        self.client = client
+        self.callback = callback
+        self.on_finished = on_finished
+        # Discord allows 10 member edits every 10 seconds per guild
+        self.rate: float = getattr(config, "MEMBER_EDIT_RATE", 1.0)
+        self.burst: int = getattr(config, "MEMBER_EDIT_BURST", 10)
+        self.max_workers: int = getattr(config, "MEMBER_EDIT_WORKERS", 2)
+        self.max_retries: int = getattr(config, "MEMBER_EDIT_MAX_RETRIES", 5)
+        self.retry_base: float = getattr(config, "MEMBER_EDIT_RETRY_BASE", 2.0)
+        self.retry_cap: float = getattr(config, "MEMBER_EDIT_RETRY_CAP", 120.0)
+        self.guilds: dict[int, GuildEditScheduler] = {}
+        self.failures: dict[int, GuildFailures] = {}
+        self.edit_stats = EditStats()
+        self.seq = itertools.count()
+
+    def submit(
+        self,
+        member: MemberSnapshot,
+        edit: Optional[MemberEdit],
+        priority: EditPriority,
+        entry_ids: Optional[list[str]] = None,
+        pending: Optional[PendingMember] = None,
+    ) -> None:
+        guild = self.guilds.get(member.guild.id)
+        if guild is None:
+            guild = self.guilds[member.guild.id] = GuildEditScheduler(self)
+
+        guild.submit(
+            EditJob(priority, next(self.seq), member, edit, pending, entry_ids or [])
+        )
+
+    def has_job(self, member: MemberSnapshot) -> bool:
+        """Whether a member has an edit queued, being sent or waiting to be retried"""
+        guild = self.guilds.get(member.guild.id)
+        return guild is not None and member.id in guild.jobs
+
+    def handle_failure(self, job: EditJob, error: Exception) -> Optional[float]:
+        """Record a failed edit. Returns the delay before retrying it, or None if it shouldn't be retried."""
+        member = job.member
+        failures = self.failures.get(member.guild.id)
+        if failures is None:
+            failures = self.failures[member.guild.id] = GuildFailures()
+        failures.last_error = f"{type(error).__name__}: {error}"
+
+        if not is_retryable(error):
+            failures.permanent += 1
+            self.client.log(
+                LogLevel.INFO,
+                f"Failed to edit member {member.id} ({member.display_name}): {error}",
+            )
+            return None
+
+        if job.attempts >= self.max_retries:
+            failures.gave_up += 1
+            self.client.log(
+                LogLevel.INFO,
+                f"Gave up editing member {member.id} ({member.display_name}) after {job.attempts + 1} attempts: {error}",
+            )
+            return None
+
+        failures.retried += 1
+        delay = min(self.retry_cap, self.retry_base * 2**job.attempts)
+        delay *= random.uniform(0.5, 1)
+        self.client.log(
+            LogLevel.DEBUG,
+            f"Retrying edit of member {member.id} g/{member.guild.id} in {delay:.1f}s: {error}",
+        )
+        return delay
+
+    def depth(self, guild_id: int) -> int:
+        """The number of members with edits queued in a guild"""
+        guild = self.guilds.get(guild_id)
+        return guild.depth if guild else 0
+
+    def prune(self) -> None:
+        """Forget about guilds with nothing queued"""
+        for guild_id in [k for k, v in self.guilds.items() if v.idle]:
+            del self.guilds[guild_id]
+
+    async def join(self, timeout: Optional[float] = None) -> None:
+        """Wait for all queued edits to be sent"""
+        await asyncio.wait_for(
+            asyncio.gather(*(guild.queue.join() for guild in self.guilds.values())),
+            timeout,
+        )
+
+    def stats(self) -> dict[str, Any]:
+        """The queue depth and wait times across all guilds"""
+        depths = [guild.depth for guild in self.guilds.values() if guild.depth]
+        return {
+            "queued": sum(depths),
+            "busy_guilds": len(depths),
+            "max_queued": max(depths, default=0),
+            "workers": sum(len(guild.workers) for guild in self.guilds.values()),
+            "sent": self.edit_stats.sent,
+            "avg_wait": self.edit_stats.total_wait / max(self.edit_stats.sent, 1),
+            "last_wait": self.edit_stats.last_wait,
+            "max_wait": self.edit_stats.max_wait,
+            "retried": sum(f.retried for f in self.failures.values()),
+            "permanent_failures": sum(f.permanent for f in self.failures.values()),
+            "gave_up": sum(f.gave_up for f in self.failures.values()),
+        }
@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+import time
+from typing import Optional
+
+import discord
+
+from utils.types import JoinableChannel
+
+
+class MemberSnapshot:
+    """
+    The parts of a member the voice state pipeline needs, taken when an event is received.
+    Used instead of copying the member, so queued members don't keep its role list and user alive.
+    """
+
+    __slots__ = (
+        "id",
+        "guild",
+        "name",
+        "display_name",
+        "tag",
+        "avatar",
+        "role_ids",
+        "taken_at",
+    )
+
+    def __init__(self, member: discord.Member) -> None:
+        self.id = member.id
+        self.guild = member.guild
+        self.name = member.name
+        self.display_name = member.display_name
+        self.tag = str(member)
+        self.avatar = member.avatar
+        # _roles excludes @everyone and avoids building a sorted list of Role objects
+        self.role_ids = tuple(member._roles)
+        self.taken_at = time.monotonic()
+
+    def __str__(self) -> str:
+        return self.tag
+
+    @property
+    def mention(self) -> str:
+        return f"<@{self.id}>"
+
+
+class VoiceStateSnapshot:
+    """The channel and speaker state of a voice state when an event is received"""
+
+    __slots__ = ("channel", "suppress")
+
+    def __init__(self, voice_state: discord.VoiceState) -> None:
+        self.channel: Optional[JoinableChannel] = voice_state.channel  # type: ignore
+        self.suppress = voice_state.suppress